@@ -1,25 +1,575 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Blueprint, current_app, request, jsonify, Response, stream_with_context, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
-from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
+from flask_sqlalchemy.session import Session
+from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity, get_jwt
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.dialects import postgresql, sqlite
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from functools import wraps
+from itertools import islice, repeat
 from flask_cors import CORS
+import click
+import csv
+import hashlib
+import io
+import json
+import math
 import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+import zlib
 
-app = Flask(__name__)
-# Configure CORS to allow requests from the frontend
-CORS(app)
+class RoutingSession(Session):
+    """Session that sends reads made while serving GET requests to the read engine.
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///subscription_system.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'dev-secret-key')
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=1)
-app.config['JWT_TOKEN_LOCATION'] = ['headers']
-app.config['JWT_HEADER_NAME'] = 'Authorization'
-app.config['JWT_HEADER_TYPE'] = 'Bearer'
+    Flushes and INSERT/UPDATE/DELETE statements always use the primary;
+    see read_engine().
+    """
 
-db = SQLAlchemy(app)
-jwt = JWTManager(app)
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not getattr(clause, 'is_dml', False):
+            engine = read_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+jwt = JWTManager()
+# Routes, request hooks and CLI commands, registered on the app by create_app
+bp = Blueprint('api', __name__, cli_group=None)
+
+# Database engine profiles: SQLite PRAGMAs applied to every new connection
+# and SQLAlchemy engine options, selected with DB_PROFILE
+DB_PROFILES = {
+    'default': {
+        'pragmas': {},
+        'engine_options': {}
+    },
+    'production': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64000,  # KiB
+            'temp_store': 'MEMORY'
+        },
+        'engine_options': {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+            'pool_timeout': 30,
+            'pool_recycle': 1800,
+            'pool_pre_ping': True
+        }
+    }
+}
+
+def create_app(config=None):
+    """Build the application; `config` overrides the environment settings.
+
+    Nothing here touches the database, so worker boot stays fast. Create
+    the schema and the admin user with `flask init-db`.
+    """
+    app = Flask(__name__)
+    # Configure CORS to allow requests from the frontend
+    CORS(app)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///subscription_system.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'dev-secret-key')
+    app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=1)
+    app.config['JWT_TOKEN_LOCATION'] = ['headers']
+    app.config['JWT_HEADER_NAME'] = 'Authorization'
+    app.config['JWT_HEADER_TYPE'] = 'Bearer'
+    # How long a cached token version is trusted before re-reading it from the database
+    app.config['TOKEN_VERSION_CACHE_TTL'] = int(os.environ.get('TOKEN_VERSION_CACHE_TTL', 30))
+    app.config['TOKEN_VERSION_CACHE_SIZE'] = 10000
+    # Seconds between background expiry sweeps (which also purge expired
+    # idempotency keys and compact the change outbox); 0 disables the sweeper
+    # thread, and then `flask expire-subscriptions` must run on a schedule to
+    # keep the analytics active counts from including expired subscriptions
+    app.config['EXPIRY_SWEEP_INTERVAL'] = int(os.environ.get('EXPIRY_SWEEP_INTERVAL', 60))
+    app.config['EXPIRY_SWEEP_BATCH_SIZE'] = int(os.environ.get('EXPIRY_SWEEP_BATCH_SIZE', 1000))
+    # SQLite file shared by all workers for cache version counters; unset keeps them in-process
+    app.config['VERSION_STORE_PATH'] = os.environ.get('VERSION_STORE_PATH')
+    # Without VERSION_STORE_PATH, writes in other workers are not seen, so
+    # version-keyed caches and ETags are only trusted this many seconds;
+    # 0 trusts them until the next local write (single worker only)
+    app.config['LOCAL_VERSION_MAX_AGE'] = float(os.environ.get('LOCAL_VERSION_MAX_AGE', 10))
+    # Password hashing: werkzeug method string, worker processes (0 hashes inline),
+    # extra requests allowed to queue, and seconds to wait for a result
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+    app.config['PASSWORD_HASH_QUEUE_SIZE'] = int(os.environ.get('PASSWORD_HASH_QUEUE_SIZE', 16))
+    app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+    # Token buckets guarding /login and /register, per client IP and per
+    # username: burst size and tokens refilled per minute; a burst of 0
+    # disables that limit
+    app.config['AUTH_RATE_LIMIT_IP_BURST'] = int(os.environ.get('AUTH_RATE_LIMIT_IP_BURST', 20))
+    app.config['AUTH_RATE_LIMIT_IP_PER_MINUTE'] = float(os.environ.get('AUTH_RATE_LIMIT_IP_PER_MINUTE', 10))
+    app.config['AUTH_RATE_LIMIT_USERNAME_BURST'] = int(os.environ.get('AUTH_RATE_LIMIT_USERNAME_BURST', 5))
+    app.config['AUTH_RATE_LIMIT_USERNAME_PER_MINUTE'] = float(os.environ.get('AUTH_RATE_LIMIT_USERNAME_PER_MINUTE', 2))
+    # SQLite file shared by all workers for the rate limit buckets; unset keeps them in-process
+    app.config['RATE_LIMIT_STORE_PATH'] = os.environ.get('RATE_LIMIT_STORE_PATH')
+    # Reverse proxies in front of the app that append to X-Forwarded-For; the
+    # client IP used for rate limits is taken from that header instead of the
+    # socket address. Leave at 0 when clients connect directly, as they could
+    # otherwise pick their own IP.
+    app.config['TRUSTED_PROXY_COUNT'] = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+    # Rows validated and inserted per transaction by the bulk import endpoints
+    app.config['BULK_CHUNK_SIZE'] = int(os.environ.get('BULK_CHUNK_SIZE', 5000))
+    # Statements slower than this many seconds are logged with their parameters; 0 disables
+    app.config['SLOW_QUERY_THRESHOLD'] = float(os.environ.get('SLOW_QUERY_THRESHOLD', 0))
+    # Add X-SQL-Count / X-SQL-Time headers to every response (useful in CI)
+    app.config['SQL_STATS_HEADERS'] = os.environ.get('SQL_STATS_HEADERS', '') == '1'
+    # Compiled per-user feature maps: seconds an entry may live and maximum entries
+    app.config['ENTITLEMENT_CACHE_TTL'] = int(os.environ.get('ENTITLEMENT_CACHE_TTL', 30))
+    app.config['ENTITLEMENT_CACHE_SIZE'] = int(os.environ.get('ENTITLEMENT_CACHE_SIZE', 100000))
+    # JSON, NDJSON and CSV responses of at least this many bytes are compressed
+    # for clients that accept it (brotli when installed, else gzip), and the
+    # gzip level (1-9); streamed responses are always compressed
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+    # Serialized GET /subscriptions responses: seconds an entry may live and maximum entries
+    app.config['SUBSCRIPTION_LIST_CACHE_TTL'] = int(os.environ.get('SUBSCRIPTION_LIST_CACHE_TTL', 300))
+    app.config['SUBSCRIPTION_LIST_CACHE_SIZE'] = int(os.environ.get('SUBSCRIPTION_LIST_CACHE_SIZE', 10000))
+    # Seconds a stored Idempotency-Key response is replayed before it is purged
+    app.config['IDEMPOTENCY_KEY_TTL'] = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 86400))
+    # Renewal engine: default look-ahead window in hours, worker processes
+    # (0 renews inline) and subscriptions renewed per transaction
+    app.config['RENEWAL_WINDOW_HOURS'] = float(os.environ.get('RENEWAL_WINDOW_HOURS', 24))
+    app.config['RENEWAL_WORKERS'] = int(os.environ.get('RENEWAL_WORKERS', os.cpu_count() or 1))
+    app.config['RENEWAL_BATCH_SIZE'] = int(os.environ.get('RENEWAL_BATCH_SIZE', 1000))
+    # Deleted users are purged in the background: subscription rows deleted per
+    # transaction and seconds to pause between transactions for other writers
+    app.config['USER_PURGE_CHUNK_SIZE'] = int(os.environ.get('USER_PURGE_CHUNK_SIZE', 500))
+    app.config['USER_PURGE_PAUSE'] = float(os.environ.get('USER_PURGE_PAUSE', 0.01))
+    # Change feed outbox: hours every change is kept, and hours after which a
+    # change superseded by a newer one to the same entity is compacted away
+    # (0 keeps superseded changes for the whole retention period)
+    app.config['CHANGE_RETENTION_HOURS'] = float(os.environ.get('CHANGE_RETENTION_HOURS', 168))
+    app.config['CHANGE_COMPACT_AFTER_HOURS'] = float(os.environ.get('CHANGE_COMPACT_AFTER_HOURS', 24))
+    # Seconds between outbox checks by long-poll and stream readers, which see
+    # changes committed by other processes this way; and seconds between
+    # keep-alive comments on an idle change stream
+    app.config['CHANGES_POLL_INTERVAL'] = float(os.environ.get('CHANGES_POLL_INTERVAL', 1))
+    app.config['CHANGES_KEEPALIVE'] = float(os.environ.get('CHANGES_KEEPALIVE', 15))
+    # Engine profile from DB_PROFILES
+    app.config['DB_PROFILE'] = os.environ.get('DB_PROFILE', 'default')
+    # Database for reads made by GET requests: a replica, or read-only
+    # connections to the primary SQLite file under WAL (DB_PROFILE=production),
+    # e.g. sqlite:///file:subscription_system.db?mode=ro&uri=true. Unset sends
+    # every statement to the primary.
+    app.config['DATABASE_READ_URL'] = os.environ.get('DATABASE_READ_URL')
+    # Seconds a user's GET requests stay on the primary after they write, so
+    # they read their own writes despite replica lag; also how long after a
+    # write conditional listings are answered from the primary
+    app.config['READ_YOUR_WRITES_WINDOW'] = float(os.environ.get('READ_YOUR_WRITES_WINDOW', 5))
+    app.config.update(config or {})
+    profile = DB_PROFILES[app.config['DB_PROFILE']]
+    app.config.setdefault('SQLITE_PRAGMAS', profile['pragmas'])
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', profile['engine_options'])
+    if app.config['DATABASE_READ_URL']:
+        app.config.setdefault('SQLALCHEMY_BINDS', {})[READ_BIND] = app.config['DATABASE_READ_URL']
+
+    if app.config['TRUSTED_PROXY_COUNT']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXY_COUNT'])
+
+    db.init_app(app)
+    jwt.init_app(app)
+    app.register_blueprint(bp)
+    with app.app_context():
+        for engine in db.engines.values():
+            db.event.listen(engine, 'connect', set_sqlite_pragmas)
+            db.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+            db.event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    password_hasher.configure(
+        app.config['PASSWORD_HASH_METHOD'],
+        app.config['PASSWORD_HASH_WORKERS'],
+        app.config['PASSWORD_HASH_QUEUE_SIZE'],
+        app.config['PASSWORD_HASH_TIMEOUT']
+    )
+    auth_rate_limiter.configure(open_rate_limit_store(app.config['RATE_LIMIT_STORE_PATH']), {
+        'ip': (app.config['AUTH_RATE_LIMIT_IP_BURST'], app.config['AUTH_RATE_LIMIT_IP_PER_MINUTE']),
+        'username': (app.config['AUTH_RATE_LIMIT_USERNAME_BURST'],
+                     app.config['AUTH_RATE_LIMIT_USERNAME_PER_MINUTE'])
+    })
+    token_versions.configure(
+        app.config['TOKEN_VERSION_CACHE_TTL'],
+        app.config['TOKEN_VERSION_CACHE_SIZE']
+    )
+    entitlement_cache.configure(
+        app.config['ENTITLEMENT_CACHE_SIZE'],
+        app.config['ENTITLEMENT_CACHE_TTL']
+    )
+    subscription_list_cache.configure(
+        app.config['SUBSCRIPTION_LIST_CACHE_SIZE'],
+        app.config['SUBSCRIPTION_LIST_CACHE_TTL']
+    )
+    global version_store
+    version_store = open_version_store(app.config['VERSION_STORE_PATH'], app.config['LOCAL_VERSION_MAX_AGE'])
+    start_expiry_sweeper(app)
+    return app
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in current_app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+# Request metrics
+class RouteMetrics:
+    """Per-route latency histograms and SQL statement/time totals."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, seconds, sql_count, sql_seconds):
+        with self._lock:
+            route = self._routes.setdefault(labels, {
+                'buckets': [0] * len(self.BUCKETS),
+                'count': 0,
+                'sum': 0.0,
+                'sql_statements': 0,
+                'sql_seconds': 0.0
+            })
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    route['buckets'][i] += 1
+            route['count'] += 1
+            route['sum'] += seconds
+            route['sql_statements'] += sql_count
+            route['sql_seconds'] += sql_seconds
+
+    def render(self):
+        with self._lock:
+            routes = {labels: dict(route, buckets=list(route['buckets']))
+                      for labels, route in self._routes.items()}
+        lines = [
+            '# HELP http_request_duration_seconds Request latency by route.',
+            '# TYPE http_request_duration_seconds histogram'
+        ]
+        for (endpoint, method, status), route in sorted(routes.items()):
+            labels = f'endpoint="{endpoint}",method="{method}",status="{status}"'
+            for bound, count in zip(self.BUCKETS, route['buckets']):
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {route["count"]}')
+            lines.append(f'http_request_duration_seconds_sum{{{labels}}} {route["sum"]:.6f}')
+            lines.append(f'http_request_duration_seconds_count{{{labels}}} {route["count"]}')
+        lines += [
+            '# HELP http_request_sql_statements_total SQL statements executed by route.',
+            '# TYPE http_request_sql_statements_total counter'
+        ]
+        for (endpoint, method, status), route in sorted(routes.items()):
+            labels = f'endpoint="{endpoint}",method="{method}",status="{status}"'
+            lines.append(f'http_request_sql_statements_total{{{labels}}} {route["sql_statements"]}')
+        lines += [
+            '# HELP http_request_db_seconds_total Time spent in SQL statements by route.',
+            '# TYPE http_request_db_seconds_total counter'
+        ]
+        for (endpoint, method, status), route in sorted(routes.items()):
+            labels = f'endpoint="{endpoint}",method="{method}",status="{status}"'
+            lines.append(f'http_request_db_seconds_total{{{labels}}} {route["sql_seconds"]:.6f}')
+        return lines
+
+route_metrics = RouteMetrics()
+# Callables returning extra Prometheus text lines for /metrics
+metrics_collectors = [route_metrics.render]
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's own execution context: a statement that raises
+    # never reaches after_cursor_execute, so nothing is left behind
+    context._query_start_time = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_start_time
+    if has_request_context():
+        g.sql_count = g.get('sql_count', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+    threshold = current_app.config['SLOW_QUERY_THRESHOLD']
+    if threshold and elapsed >= threshold:
+        current_app.logger.warning(f"Slow query ({elapsed:.3f}s): {statement} {parameters!r}")
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.sql_count = 0
+    g.sql_seconds = 0.0
+
+@bp.after_app_request
+def record_request_metrics(response):
+    if 'request_started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    route_metrics.observe((endpoint, request.method, response.status_code),
+                          elapsed, g.sql_count, g.sql_seconds)
+    if current_app.config['SQL_STATS_HEADERS']:
+        response.headers['X-SQL-Count'] = str(g.sql_count)
+        response.headers['X-SQL-Time'] = f'{g.sql_seconds:.6f}'
+    return response
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    lines = []
+    for collect in metrics_collectors:
+        lines.extend(collect())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+# Password hashing
+class PasswordHasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    """Runs password hashing in a bounded process pool.
+
+    At most `workers + queue_size` hashes are in flight; further calls
+    raise PasswordHasherBusy instead of piling up behind the pool.
+    """
+
+    def __init__(self, method='pbkdf2:sha256:260000', workers=0, queue_size=16, timeout=10):
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self.configure(method, workers, queue_size, timeout)
+
+    def configure(self, method, workers, queue_size, timeout):
+        self.method = method
+        self.timeout = timeout
+        self._stored_method = None
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        with self._pool_lock:
+            if self._pool is not None and workers != self.workers:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+            self.workers = workers
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            future = self._get_pool().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordHasherBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def hash_many(self, passwords):
+        """Hash a batch of passwords across the whole pool (bulk imports)."""
+        if not self.workers:
+            return [generate_password_hash(password, self.method) for password in passwords]
+        return list(self._get_pool().map(
+            generate_password_hash, passwords, repeat(self.method), chunksize=64
+        ))
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Whether `pwhash` was made with other settings than `method`.
+
+        Compared with the prefix werkzeug writes for `method`, which spells
+        out defaults such as the PBKDF2 iteration count; found by hashing
+        once, on first use, so startup stays fast.
+        """
+        if self._stored_method is None:
+            self._stored_method = generate_password_hash('', self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._stored_method
+
+# Configured from the app settings by create_app
+password_hasher = PasswordHasher()
+
+@bp.app_errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    response = jsonify({'message': 'Server is busy, please retry shortly'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# Rate limiting
+class LocalRateLimitStore:
+    """Token buckets kept in this process, as (tokens, updated) tuples.
+
+    The least recently used buckets are dropped beyond `max_keys`; a
+    dropped bucket simply starts full again.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, per_second, now):
+        """Take a token; returns 0 if allowed, else seconds until one is available."""
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * per_second)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return 0 if allowed else (1 - tokens) / per_second
+
+    def __len__(self):
+        return len(self._buckets)
+
+class SQLiteRateLimitStore:
+    """Token buckets in a SQLite file shared by all workers."""
+
+    # Buckets untouched this long are full again and are deleted
+    IDLE_SECONDS = 3600
+    PURGE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets '
+                         '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, burst, per_second, now):
+        """Take a token; returns 0 if allowed, else seconds until one is available."""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row or (burst, now)
+            tokens = min(burst, tokens + (now - updated) * per_second)
+            allowed = tokens >= 1
+            conn.execute(
+                'INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                (key, tokens - 1 if allowed else tokens, now)
+            )
+            self._takes += 1
+            if self._takes % self.PURGE_EVERY == 0:
+                conn.execute('DELETE FROM buckets WHERE updated < ?', (now - self.IDLE_SECONDS,))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return 0 if allowed else (1 - tokens) / per_second
+
+    def __len__(self):
+        return self._connect().execute('SELECT count(*) FROM buckets').fetchone()[0]
+
+def open_rate_limit_store(path):
+    """A SQLiteRateLimitStore at `path`, or a LocalRateLimitStore when unset."""
+    return SQLiteRateLimitStore(path) if path else LocalRateLimitStore()
+
+class RateLimiter:
+    """Token-bucket limits per client IP and per username for the auth routes.
+
+    `limits` maps 'ip' and 'username' to (burst, tokens per minute).
+    Allowed and rejected requests are counted for /metrics.
+    """
+
+    def __init__(self):
+        self.store = LocalRateLimitStore()
+        self.limits = {}
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def configure(self, store, limits):
+        for kind, (burst, per_minute) in limits.items():
+            if burst and per_minute <= 0:
+                raise ValueError(f'{kind} rate limit: a burst of {burst} needs a positive refill per minute')
+        self.store = store
+        self.limits = limits
+
+    def check(self, endpoint, ip, username):
+        """Take a token from each bucket; returns seconds to wait, or 0 if allowed."""
+        now = time.time()
+        result, retry_after = 'allowed', 0
+        for kind, value in (('ip', ip), ('username', username)):
+            burst, per_minute = self.limits.get(kind, (0, 0))
+            if not burst or value is None:
+                continue
+            retry_after = self.store.take(f'{endpoint}:{kind}:{value}', burst, per_minute / 60, now)
+            if retry_after:
+                result = f'{kind}_limited'
+                break
+        with self._lock:
+            self._counts[(endpoint, result)] += 1
+        return retry_after
+
+    def render(self):
+        with self._lock:
+            counts = sorted(self._counts.items())
+        lines = [
+            '# HELP auth_rate_limit_requests_total Auth requests by rate limit outcome.',
+            '# TYPE auth_rate_limit_requests_total counter'
+        ]
+        for (endpoint, result), count in counts:
+            lines.append(f'auth_rate_limit_requests_total{{endpoint="{endpoint}",result="{result}"}} {count}')
+        if isinstance(self.store, LocalRateLimitStore):
+            lines += [
+                '# HELP auth_rate_limit_buckets Rate limit buckets held in this process.',
+                '# TYPE auth_rate_limit_buckets gauge',
+                f'auth_rate_limit_buckets {len(self.store)}'
+            ]
+        return lines
+
+# Configured from the app settings by create_app
+auth_rate_limiter = RateLimiter()
+metrics_collectors.append(auth_rate_limiter.render)
+
+def rate_limited(fn):
+    """Reject the request with 429 when its IP or username is over the limit.
+
+    Runs before the view, so a rejected request costs no hashing and no
+    database work.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        data = request.get_json(silent=True)
+        username = data.get('username') if isinstance(data, dict) else None
+        if username is not None:
+            username = str(username).strip().lower()
+        retry_after = auth_rate_limiter.check(request.url_rule.rule, request.remote_addr, username)
+        if retry_after:
+            response = jsonify({'message': 'Too many attempts, please retry later'})
+            response.headers['Retry-After'] = str(math.ceil(retry_after))
+            return response, 429
+        return fn(*args, **kwargs)
+    return wrapper
 
 # Models
 class User(db.Model):
@@ -28,14 +578,18 @@ class User(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
     role = db.Column(db.String(20), nullable=False, default='user')  # 'user', 'admin'
+    # Bumped whenever the role changes so tokens carrying the old role are rejected
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Set by DELETE /users/<id>; the row is purged in the background
+    is_deleted = db.Column(db.Boolean, nullable=False, default=False, server_default='0', index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     subscriptions = db.relationship('Subscription', backref='user', lazy=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
 
 class Plan(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -56,10 +610,203 @@ class Subscription(db.Model):
     end_date = db.Column(db.DateTime, nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    cancelled_at = db.Column(db.DateTime)
+
+    # Indexes matching the route access patterns: lookups by user (and plan),
+    # filtering by plan, and active/expiry range scans on end_date. The
+    # partial unique index allows one active subscription per user and plan
+    # and is the conflict target of create_subscription's INSERT.
+    __table_args__ = (
+        db.Index('ix_subscription_user_plan_active', 'user_id', 'plan_id', 'is_active'),
+        db.Index('uq_subscription_user_plan_active', 'user_id', 'plan_id', unique=True,
+                 sqlite_where=is_active == True, postgresql_where=is_active == True),
+        db.Index('ix_subscription_plan_id', 'plan_id'),
+        db.Index('ix_subscription_active_end_date', 'is_active', 'end_date'),
+        db.Index('ix_subscription_end_date', 'end_date'),
+    )
     
     def is_expired(self):
         return datetime.utcnow() > self.end_date
 
+# Aggregates maintained in the same transaction as subscription writes
+class PlanStats(db.Model):
+    plan_id = db.Column(db.Integer, primary_key=True)
+    active_subscriptions = db.Column(db.Integer, nullable=False, default=0)
+
+class DailyStats(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    plan_id = db.Column(db.Integer, primary_key=True)
+    new_subscriptions = db.Column(db.Integer, nullable=False, default=0)
+    cancelled_subscriptions = db.Column(db.Integer, nullable=False, default=0)
+    renewals = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+
+# Renewal runs and their per-user_id-range checkpoints, so an interrupted
+# run resumes where each partition left off
+class RenewalRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    window_start = db.Column(db.DateTime, nullable=False)
+    window_end = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    renewed = db.Column(db.Integer, nullable=False, default=0)
+
+class RenewalPartition(db.Model):
+    run_id = db.Column(db.Integer, db.ForeignKey('renewal_run.id'), primary_key=True)
+    low_user_id = db.Column(db.Integer, primary_key=True)
+    high_user_id = db.Column(db.Integer, nullable=False)
+    last_subscription_id = db.Column(db.Integer, nullable=False, default=0)
+    renewed = db.Column(db.Integer, nullable=False, default=0)
+    completed = db.Column(db.Boolean, nullable=False, default=False)
+
+# Time-limited claims on jobs that must not run twice at once, across
+# processes; see acquire_lease()
+class JobLease(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(32), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+# Responses stored for requests sent with an Idempotency-Key header. The key
+# is a digest of the caller, route and client key, so rows stay fixed-size.
+class IdempotencyKey(db.Model):
+    key = db.Column(db.String(64), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    body = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+# Outbox of subscription, plan and user changes, written in the same
+# transaction as the change itself. The id is the consumers' cursor, so
+# AUTOINCREMENT keeps ids from being reused after old rows are compacted.
+class ChangeEvent(db.Model):
+    __table_args__ = (
+        db.Index('ix_change_event_entity', 'entity', 'entity_id', 'id'),
+        {'sqlite_autoincrement': True}
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(20), nullable=False)
+    data = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+# Serialization
+try:
+    # Optional: orjson encodes large lists several times faster than json
+    import orjson
+except ImportError:
+    orjson = None
+
+json_encoder = json.JSONEncoder(separators=(',', ':'))
+
+def dumps_json(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json_encoder.encode(data).encode()
+
+def json_response(data, status=200):
+    return Response(dumps_json(data), status=status, mimetype='application/json')
+
+def isoformat(value):
+    return value.isoformat() if value is not None else None
+
+class Projection:
+    """Column projection for a model's JSON shape.
+
+    Selects only the requested columns as tuples, so list endpoints skip
+    ORM hydration, and converts them to dicts with per-field converters.
+    `fields` maps output names to column expressions; `joins` maps names
+    that need another table to (target, onclause).
+    """
+
+    def __init__(self, model, fields, joins=None, converters=None):
+        self.model = model
+        self.fields = fields
+        self.joins = joins or {}
+        self.converters = converters or {}
+
+    def parse_fields(self, value, default):
+        """Validate a comma-separated `?fields=` value against the known fields."""
+        if not value:
+            return list(default)
+        names = [name.strip() for name in value.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            raise ValueError(f"unknown fields: {', '.join(unknown)}")
+        return names
+
+    def select(self, names):
+        statement = db.select(*(self.fields[name].label(name) for name in names)).select_from(self.model)
+        joined = set()
+        for name in names:
+            if name in self.joins and self.joins[name][0] not in joined:
+                target, onclause = self.joins[name]
+                statement = statement.join(target, onclause)
+                joined.add(target)
+        return statement
+
+    def serialize(self, rows, names):
+        converters = [(name, self.converters.get(name)) for name in names]
+        return [{
+            name: convert(value) if convert else value
+            for (name, convert), value in zip(converters, row)
+        } for row in rows]
+
+    def serialize_object(self, obj, names):
+        return self.serialize([tuple(getattr(obj, name) for name in names)], names)[0]
+
+    def fetch(self, names, *criteria, order_by=None, limit=None):
+        statement = self.select(names).where(*criteria)
+        if order_by is not None:
+            statement = statement.order_by(order_by)
+        if limit is not None:
+            statement = statement.limit(limit)
+        return self.serialize(db.session.execute(statement, {'now': datetime.utcnow()}), names)
+
+USER_PROJECTION = Projection(User, {
+    'id': User.id,
+    'username': User.username,
+    'email': User.email,
+    'role': User.role,
+    'created_at': User.created_at
+}, converters={'created_at': isoformat})
+USER_FIELDS = ('id', 'username', 'email', 'role', 'created_at')
+
+PLAN_PROJECTION = Projection(Plan, {
+    'id': Plan.id,
+    'name': Plan.name,
+    'description': Plan.description,
+    'price': Plan.price,
+    'duration_days': Plan.duration_days,
+    'features': Plan.features,
+    'is_active': Plan.is_active,
+    'created_at': Plan.created_at
+}, converters={'created_at': isoformat})
+PLAN_PUBLIC_FIELDS = ('id', 'name', 'description', 'price', 'duration_days', 'features')
+PLAN_FIELDS = PLAN_PUBLIC_FIELDS + ('is_active',)
+
+SUBSCRIPTION_PROJECTION = Projection(Subscription, {
+    'id': Subscription.id,
+    'user_id': Subscription.user_id,
+    'username': User.username,
+    'plan_id': Subscription.plan_id,
+    'plan_name': Plan.name,
+    'start_date': Subscription.start_date,
+    'end_date': Subscription.end_date,
+    # True state: stored flag and not yet past end_date (bound as :now)
+    'is_active': db.type_coerce(
+        db.and_(Subscription.is_active == True,
+                Subscription.end_date >= db.bindparam('now', type_=db.DateTime)),
+        db.Boolean
+    )
+}, joins={
+    'username': (User, Subscription.user_id == User.id),
+    'plan_name': (Plan, Subscription.plan_id == Plan.id)
+}, converters={'start_date': isoformat, 'end_date': isoformat})
+SUBSCRIPTION_FIELDS = ('id', 'plan_id', 'plan_name', 'start_date', 'end_date', 'is_active')
+SUBSCRIPTION_ADMIN_FIELDS = ('id', 'user_id', 'username', 'plan_id', 'plan_name',
+                             'start_date', 'end_date', 'is_active')
+
 # rror handling for JWT
 @jwt.unauthorized_loader
 def unauthorized_response(callback):
@@ -79,8 +826,564 @@ def expired_token_callback(jwt_header, jwt_payload):
         'message': 'Token has expired'
     }), 401
 
+@jwt.revoked_token_loader
+def revoked_token_callback(jwt_header, jwt_payload):
+    return jsonify({
+        'message': 'Token has been revoked, please log in again'
+    }), 401
+
+class TokenVersionCache:
+    """Small LRU cache of User.token_version keyed by user id.
+
+    Entries are trusted for `ttl` seconds, so a role change made in another
+    worker is picked up within that window; changes made in this worker are
+    applied immediately through `set`.
+    """
+
+    def __init__(self, ttl=30, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, ttl, max_size):
+        with self._lock:
+            self.ttl = ttl
+            self.max_size = max_size
+            self._entries.clear()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                return None, False
+            self._entries.move_to_end(user_id)
+            return entry[0], True
+
+    def set(self, user_id, version):
+        with self._lock:
+            self._entries[user_id] = (version, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+# Configured from the app settings by create_app
+token_versions = TokenVersionCache()
+
+@jwt.token_in_blocklist_loader
+def check_token_version(jwt_header, jwt_payload):
+    user_id = int(jwt_payload['sub'])
+    version, cached = token_versions.get(user_id)
+    if not cached:
+        # A deleted user has no version, which revokes all of their tokens
+        version = db.session.query(User.token_version).filter_by(id=user_id, is_deleted=False).scalar()
+        token_versions.set(user_id, version)
+    return version is None or jwt_payload.get('ver', 0) != version
+
+def admin_required(fn):
+    """Require a valid token whose role claim is 'admin'.
+
+    Authorizes from the token claims; stale tokens are rejected by
+    `check_token_version` without loading the user row.
+    """
+    @wraps(fn)
+    @jwt_required()
+    def wrapper(*args, **kwargs):
+        if get_jwt().get('role') != 'admin':
+            return jsonify({'message': 'Unauthorized'}), 403
+        return fn(*args, **kwargs)
+    return wrapper
+
+# Cache version counters
+class LocalVersionStore:
+    """Named version counters kept in this process.
+
+    Bumps made by other workers are invisible here, so `get` pairs each
+    counter with the current `max_age`-second period: anything keyed on a
+    version (cached bodies, ETags) outlives a write made elsewhere by at
+    most `max_age` seconds. 0 disables this, for a single worker.
+
+    Counters restart at 0 with the process, so `epoch` is new every time;
+    include it in anything (like ETags) that outlives the process.
+    """
+
+    def __init__(self, max_age=0):
+        self.max_age = max_age
+        self._versions = {}
+        self._touched = OrderedDict()
+        self._lock = threading.Lock()
+        self.epoch = secrets.randbits(48)
+
+    def get(self, name):
+        period = int(time.time() // self.max_age) if self.max_age else 0
+        return (self._versions.get(name, 0), period)
+
+    def bump(self, name):
+        with self._lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+            return self._versions[name]
+
+    def bump_many(self, names):
+        with self._lock:
+            for name in names:
+                self._versions[name] = self._versions.get(name, 0) + 1
+
+    def touch(self, *names):
+        """Record the current time under each name; see `touched`."""
+        now = time.time()
+        with self._lock:
+            for name in names:
+                self._touched[name] = now
+                self._touched.move_to_end(name)
+            while len(self._touched) > TOUCHED_MAX_SIZE:
+                self._touched.popitem(last=False)
+
+    def touched(self, name):
+        """When `name` was last touched (epoch seconds), or None."""
+        return self._touched.get(name)
+
+class SQLiteVersionStore:
+    """Named version counters in a SQLite file shared by all workers."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS versions '
+                         '(name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS touched '
+                         '(name TEXT PRIMARY KEY, at REAL NOT NULL)')
+            # Changes only when the file is recreated and the counters restart
+            conn.execute("INSERT OR IGNORE INTO versions (name, value) VALUES ('epoch', ?)",
+                         (secrets.randbits(48),))
+        self.epoch = self.get('epoch')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, name):
+        row = self._connect().execute(
+            'SELECT value FROM versions WHERE name = ?', (name,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, name):
+        return self._connect().execute(
+            'INSERT INTO versions (name, value) VALUES (?, 1) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + 1 RETURNING value',
+            (name,)
+        ).fetchone()[0]
+
+    def bump_many(self, names):
+        """Bump several counters in one transaction."""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT INTO versions (name, value) VALUES (?, 1) '
+                'ON CONFLICT(name) DO UPDATE SET value = value + 1',
+                [(name,) for name in names]
+            )
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def touch(self, *names):
+        """Record the current time under each name; see `touched`."""
+        now = time.time()
+        self._connect().executemany(
+            'INSERT INTO touched (name, at) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET at = excluded.at',
+            [(name, now) for name in names]
+        )
+
+    def touched(self, name):
+        """When `name` was last touched (epoch seconds), or None."""
+        row = self._connect().execute(
+            'SELECT at FROM touched WHERE name = ?', (name,)
+        ).fetchone()
+        return row[0] if row else None
+
+def open_version_store(path, max_age=0):
+    """A SQLiteVersionStore at `path`, or a LocalVersionStore aging out after `max_age` seconds."""
+    return SQLiteVersionStore(path) if path else LocalVersionStore(max_age)
+
+# Names kept by LocalVersionStore.touch
+TOUCHED_MAX_SIZE = 100000
+# Replaced by create_app according to VERSION_STORE_PATH
+version_store = LocalVersionStore()
+
+# Table change counters
+# Tables whose 'table:<name>' version is bumped after every commit writing to them
+VERSIONED_TABLES = ('user', 'plan', 'subscription')
+
+def note_written_tables(session, tables):
+    session.info.setdefault('written_tables', set()).update(
+        table for table in tables if table in VERSIONED_TABLES)
+
+@db.event.listens_for(RoutingSession, 'do_orm_execute')
+def track_statement_writes(state):
+    if state.is_insert or state.is_update or state.is_delete:
+        note_written_tables(state.session, [state.statement.table.name])
+
+@db.event.listens_for(RoutingSession, 'after_flush')
+def track_flush_writes(session, flush_context):
+    note_written_tables(session, {
+        instance.__table__.name
+        for instance in (*session.new, *session.dirty, *session.deleted)
+    })
+
+@db.event.listens_for(RoutingSession, 'after_commit')
+def bump_table_versions(session):
+    session.info.pop('change_lock', None)
+    tables = session.info.pop('written_tables', None)
+    if tables:
+        names = [f'table:{table}' for table in tables]
+        version_store.bump_many(names)
+        if current_app.config['DATABASE_READ_URL']:
+            version_store.touch(*names)
+
+@db.event.listens_for(RoutingSession, 'after_rollback')
+def forget_table_writes(session):
+    session.info.pop('change_lock', None)
+    session.info.pop('written_tables', None)
+
+def table_versions(*tables):
+    return (version_store.epoch,) + tuple(version_store.get(f'table:{table}') for table in tables)
+
+class ExpiringLRUCache:
+    """Thread-safe LRU cache whose entries also expire at a wall-clock time.
+
+    `set` takes an optional `expires_at` (UTC datetime) that can only
+    shorten the default `ttl`. Hit and miss counts are kept for /metrics.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_size, ttl):
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self._entries.clear()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > datetime.utcnow():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, expires_at=None):
+        deadline = datetime.utcnow() + timedelta(seconds=self.ttl)
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        with self._lock:
+            self._entries[key] = (value, deadline)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+# Read/write routing
+# SQLALCHEMY_BINDS key of the engine built from DATABASE_READ_URL
+READ_BIND = 'read'
+READ_METHODS = ('GET', 'HEAD')
+
+def request_identity():
+    """The JWT identity of the current request, or None before it is verified."""
+    try:
+        return get_jwt_identity()
+    except RuntimeError:
+        return None
+
+def written_recently(*names):
+    """Whether any of the version store `names` was touched within READ_YOUR_WRITES_WINDOW.
+
+    The read engine is assumed to have caught up with older writes.
+    Always False without a read engine, where nothing is touched.
+    """
+    if db.engines.get(READ_BIND) is None:
+        return False
+    since = time.time() - current_app.config['READ_YOUR_WRITES_WINDOW']
+    return any((version_store.touched(name) or 0) >= since for name in names)
+
+@contextmanager
+def primary_reads(enabled=True):
+    """Send the reads made in this block to the primary.
+
+    Used to fill caches keyed on versions from the version store: the
+    versions are bumped when the primary commits, so a lagging read
+    engine would store stale data under the new version.
+    """
+    if not has_request_context():
+        yield
+        return
+    previous = g.get('primary_reads', False)
+    g.primary_reads = previous or enabled
+    try:
+        yield
+    finally:
+        g.primary_reads = previous
+
+def read_engine():
+    """The engine for reads in the current context, or None for the primary.
+
+    Only GET and HEAD requests use the read engine, outside primary_reads()
+    blocks and not for a user who wrote within READ_YOUR_WRITES_WINDOW
+    (tracked in the version store, so across workers). CLI commands and
+    background threads always use the primary.
+    """
+    if not has_request_context() or request.method not in READ_METHODS or g.get('primary_reads'):
+        return None
+    engine = db.engines.get(READ_BIND)
+    if engine is None:
+        return None
+    identity = request_identity()
+    if identity is not None:
+        if 'wrote_recently' not in g:
+            g.wrote_recently = written_recently(f'writer:{identity}')
+        if g.wrote_recently:
+            return None
+    return engine
+
+@bp.after_app_request
+def remember_writer(response):
+    if (request.method not in READ_METHODS and response.status_code < 400
+            and db.engines.get(READ_BIND) is not None):
+        identity = request_identity()
+        if identity is not None:
+            version_store.touch(f'writer:{identity}')
+    return response
+
+# Conditional and compressed responses
+try:
+    # Optional: brotli compresses JSON smaller than gzip
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv')
+BROTLI_QUALITY = 5
+
+def conditional(*tables, valid_until=None):
+    """Answer If-None-Match with 304 from table change counters alone.
+
+    The weak ETag is derived from the request path and query string, the
+    Accept header (listings may also render as NDJSON) and the versions of
+    `tables`, so a matching request is answered without running
+    the view or any query. `valid_until(versions)` may return when the
+    response changes without a write (e.g. a subscription expiring); that
+    time is part of the ETag. Within READ_YOUR_WRITES_WINDOW of a write to
+    `tables` the view reads from the primary, so the body matches the
+    versions.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with primary_reads(written_recently(*(f'table:{table}' for table in tables))):
+                return respond(*args, **kwargs)
+
+        def respond(*args, **kwargs):
+            versions = table_versions(*tables)
+            boundary = valid_until(versions) if valid_until else None
+            etag = hashlib.sha1(repr((
+                request.full_path, request.headers.get('Accept'), versions, boundary
+            )).encode()).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = current_app.make_response(fn(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.vary.add('Accept')
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+class StreamCompressor:
+    """Incremental gzip or brotli encoder."""
+
+    def __init__(self, encoding, level):
+        if encoding == 'br':
+            self._encoder = brotli.Compressor(quality=BROTLI_QUALITY)
+            self.compress = self._encoder.process
+            self.flush = self._encoder.flush
+            self.finish = self._encoder.finish
+        else:
+            self._encoder = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+            self.compress = self._encoder.compress
+            self.flush = lambda: self._encoder.flush(zlib.Z_SYNC_FLUSH)
+            self.finish = self._encoder.flush
+
+def compress_stream(chunks, encoding, level):
+    """Compress a streamed body, flushing after each chunk so it still streams."""
+    compressor = StreamCompressor(encoding, level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            yield compressor.compress(chunk) + compressor.flush()
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+@bp.after_app_request
+def compress_response(response):
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if encoding is None:
+        return response
+
+    level = current_app.config['COMPRESS_LEVEL']
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+        compressor = StreamCompressor(encoding, level)
+        response.set_data(compressor.compress(data) + compressor.finish())
+    response.headers['Content-Encoding'] = encoding
+    # A strong ETag promises identical bytes for every encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+# Idempotency keys
+def idempotency_cutoff(now=None):
+    return (now or datetime.utcnow()) - timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL'])
+
+# status_code of a key reserved by a request that is still running
+IDEMPOTENCY_PENDING = 0
+# Seconds after which a pending reservation is presumed abandoned (its
+# worker died mid-request) and a retry may claim the key again
+IDEMPOTENCY_PENDING_TIMEOUT = 60
+
+def reserve_idempotency_key(key, fingerprint):
+    """Claim `key` for the current request; returns False if already taken."""
+    now = datetime.utcnow()
+    db.session.execute(db.delete(IdempotencyKey).where(
+        IdempotencyKey.key == key,
+        db.or_(IdempotencyKey.created_at < idempotency_cutoff(now),
+               db.and_(IdempotencyKey.status_code == IDEMPOTENCY_PENDING,
+                       IdempotencyKey.created_at < now - timedelta(seconds=IDEMPOTENCY_PENDING_TIMEOUT)))
+    ))
+    result = db.session.execute(dialect_insert(IdempotencyKey).values(
+        key=key, fingerprint=fingerprint, status_code=IDEMPOTENCY_PENDING, body=b'', created_at=now
+    ).on_conflict_do_nothing(index_elements=['key']))
+    db.session.commit()
+    return result.rowcount == 1
+
+def finish_idempotency_key(key, response):
+    """Store the response of a reserved key, or release the key after a 5xx."""
+    pending = db.and_(IdempotencyKey.key == key, IdempotencyKey.status_code == IDEMPOTENCY_PENDING)
+    if response is not None and response.status_code < 500:
+        statement = db.update(IdempotencyKey).where(pending).values(
+            status_code=response.status_code, body=response.get_data())
+    else:
+        statement = db.delete(IdempotencyKey).where(pending)
+    try:
+        db.session.execute(statement)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error storing idempotency key: {str(e)}")
+
+def idempotent(fn):
+    """Replay the stored response when a request repeats its Idempotency-Key.
+
+    Keys are scoped to the caller and route. The key is reserved before the
+    view runs, so of concurrent repeats only one runs the view; the others
+    get 409 until its response is stored, and repeats after that are
+    answered from the key table. Reusing a key with a different body is
+    rejected with 422. Responses below 500 are stored and never replaced.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get('Idempotency-Key')
+        if not client_key:
+            return fn(*args, **kwargs)
+        if len(client_key) > 255:
+            return jsonify({'message': 'Idempotency-Key must be at most 255 characters'}), 400
+
+        scope = f'{get_jwt_identity()}\0{request.method}\0{request.path}\0{client_key}'
+        key = hashlib.sha256(scope.encode()).hexdigest()
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        if not reserve_idempotency_key(key, fingerprint):
+            stored = db.session.execute(
+                db.select(IdempotencyKey.fingerprint, IdempotencyKey.status_code, IdempotencyKey.body)
+                .where(IdempotencyKey.key == key)
+            ).first()
+            if stored and stored.fingerprint != fingerprint:
+                return jsonify({'message': 'Idempotency-Key was already used with a different request'}), 422
+            if stored is None or stored.status_code == IDEMPOTENCY_PENDING:
+                response = jsonify({'message': 'A request with this Idempotency-Key is in progress'})
+                response.headers['Retry-After'] = '1'
+                return response, 409
+            response = Response(stored.body, status=stored.status_code, mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        response = None
+        try:
+            response = current_app.make_response(fn(*args, **kwargs))
+        finally:
+            finish_idempotency_key(key, response)
+        return response
+    return wrapper
+
+def purge_idempotency_keys(now=None):
+    """Delete stored responses older than IDEMPOTENCY_KEY_TTL; returns the count."""
+    result = db.session.execute(
+        db.delete(IdempotencyKey).where(IdempotencyKey.created_at < idempotency_cutoff(now))
+    )
+    db.session.commit()
+    return result.rowcount
+
+@bp.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys_command():
+    """Delete expired Idempotency-Key responses."""
+    click.echo(json.dumps({'purged': purge_idempotency_keys()}))
+
 # Routes
-@app.route('/register', methods=['POST'])
+@bp.route('/register', methods=['POST'])
+@rate_limited
 def register():
     data = request.get_json()
     
@@ -102,24 +1405,31 @@ def register():
     
     return jsonify({'message': 'User created successfully'}), 201
 
-@app.route('/login', methods=['POST'])
+@bp.route('/login', methods=['POST'])
+@rate_limited
 def login():
     data = request.get_json()
-    user = User.query.filter_by(username=data['username']).first()
+    user = User.query.filter_by(username=data['username'], is_deleted=False).first()
     
     if not user or not user.check_password(data['password']):
         return jsonify({'message': 'Invalid credentials'}), 401
+
+    # Upgrade hashes made with an older method or iteration count
+    if password_hasher.needs_rehash(user.password_hash):
+        user.set_password(data['password'])
+        db.session.commit()
     
     access_token = create_access_token(
         identity=str(user.id),  
         additional_claims={
             'role': user.role,
-            'username': user.username
+            'username': user.username,
+            'ver': user.token_version
         }
     )
     return jsonify(access_token=access_token), 200
 
-@app.route('/users/me', methods=['GET'])
+@bp.route('/users/me', methods=['GET'])
 @jwt_required()
 def get_current_user():
     try:
@@ -133,20 +1443,19 @@ def get_current_user():
             'created_at': user.created_at.isoformat()
         }), 200
     except Exception as e:
-        app.logger.error(f"Error in get_current_user: {str(e)}")
+        current_app.logger.error(f"Error in get_current_user: {str(e)}")
         return jsonify({'message': f'Error retrieving user: {str(e)}'}), 500
 
-@app.route('/users/<int:id>', methods=['GET'])
+@bp.route('/users/<int:id>', methods=['GET'])
 @jwt_required()
 def get_user(id):
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get_or_404(int(current_user_id))
+        current_user_id = int(get_jwt_identity())
         
-        if current_user.role != 'admin' and current_user.id != id:
+        if get_jwt().get('role') != 'admin' and current_user_id != id:
             return jsonify({'message': 'Unauthorized'}), 403
             
-        user = User.query.get_or_404(id)
+        user = User.query.filter_by(id=id, is_deleted=False).first_or_404()
         return jsonify({
             'id': user.id,
             'username': user.username,
@@ -155,137 +1464,151 @@ def get_user(id):
             'created_at': user.created_at.isoformat()
         }), 200
     except Exception as e:
-        app.logger.error(f"Error in get_user: {str(e)}")
+        current_app.logger.error(f"Error in get_user: {str(e)}")
         return jsonify({'message': f'Error retrieving user: {str(e)}'}), 500
 
 # Get all users (for admin)
-@app.route('/users', methods=['GET'])
-@jwt_required()
+@bp.route('/users', methods=['GET'])
+@admin_required
+@conditional('user')
 def list_users():
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get_or_404(int(current_user_id))
-        
-        if current_user.role != 'admin':
-            return jsonify({'message': 'Unauthorized. Admin privileges required.'}), 403
-        
-        users = User.query.all()
-        return jsonify([{
-            'id': user.id,
-            'username': user.username,
-            'email': user.email,
-            'role': user.role,
-            'created_at': user.created_at.isoformat() if user.created_at else None
-        } for user in users]), 200
+        try:
+            fields = USER_PROJECTION.parse_fields(request.args.get('fields'), USER_FIELDS)
+        except ValueError as e:
+            return jsonify({'message': f'Invalid query parameter: {str(e)}'}), 400
+        return json_response(USER_PROJECTION.fetch(fields, User.is_deleted == False, order_by=User.id))
     except Exception as e:
-        app.logger.error(f"Error in list_users: {str(e)}")
+        current_app.logger.error(f"Error in list_users: {str(e)}")
         return jsonify({'message': f'Error listing users: {str(e)}'}), 500
 
 # Delete user
-@app.route('/users/<int:id>', methods=['DELETE'])
-@jwt_required()
+@bp.route('/users/<int:id>', methods=['DELETE'])
+@admin_required
 def delete_user(id):
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get_or_404(int(current_user_id))
-        
-        if current_user.role != 'admin':
-            return jsonify({'message': 'Unauthorized'}), 403
-            
         # Prevent deleting the admin user
         if id == 1:
             return jsonify({'message': 'Cannot delete main admin user'}), 403
         
-        user = User.query.get_or_404(id)
+        user = db.session.get(User, id)
+        if user is None or user.is_deleted:
+            return jsonify({'message': 'User not found'}), 404
         
-        # Delete user's subscriptions first
-        Subscription.query.filter_by(user_id=id).delete()
-        db.session.delete(user)
+        # Cancel the active subscriptions (at most one per plan) right away;
+        # the user's rows are deleted in small chunks by the purge worker
+        now = datetime.utcnow()
+        active = db.session.execute(
+            db.select(Subscription.id, Subscription.user_id, Subscription.plan_id,
+                      Subscription.start_date, Subscription.end_date)
+            .where(Subscription.user_id == id, Subscription.is_active == True)
+        ).all()
+        for subscription in active:
+            track_subscriptions_deactivated(subscription.plan_id, cancelled=True)
+            record_change('subscription', subscription.id, 'cancelled',
+                          subscription_change(subscription, is_active=False, cancelled_at=now))
+        db.session.execute(
+            db.update(Subscription)
+            .where(Subscription.user_id == id, Subscription.is_active == True)
+            .values(is_active=False, cancelled_at=now)
+        )
+        user.is_deleted = True
+        record_change('user', id, 'deleted', {'id': id})
         db.session.commit()
+        change_notifier.notify()
+        token_versions.set(id, None)
+        invalidate_subscriptions(id)
+        user_purger.wake()
         
-        return jsonify({'message': 'User deleted successfully'}), 200
+        return jsonify({'message': 'User scheduled for deletion'}), 202
     except Exception as e:
-        app.logger.error(f"Error in delete_user: {str(e)}")
+        current_app.logger.error(f"Error in delete_user: {str(e)}")
         return jsonify({'message': f'Error deleting user: {str(e)}'}), 500
 
 # Update user
-@app.route('/users/<int:id>', methods=['PATCH'])
-@jwt_required()
+@bp.route('/users/<int:id>', methods=['PATCH'])
+@admin_required
 def update_user(id):
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get_or_404(int(current_user_id))
-        
-        if current_user.role != 'admin':
-            return jsonify({'message': 'Unauthorized'}), 403
-            
-        user = User.query.get_or_404(id)
+        user = User.query.filter_by(id=id, is_deleted=False).first_or_404()
         data = request.get_json()
         
-        if 'role' in data:
+        if 'role' in data and data['role'] != user.role:
             user.role = data['role']
+            # Revoke tokens issued with the old role
+            user.token_version += 1
         
         db.session.commit()
+        token_versions.set(user.id, user.token_version)
         
-        return jsonify({
-            'id': user.id,
-            'username': user.username,
-            'email': user.email,
-            'role': user.role,
-            'created_at': user.created_at.isoformat()
-        }), 200
+        return json_response(USER_PROJECTION.serialize_object(user, USER_FIELDS))
     except Exception as e:
-        app.logger.error(f"Error in update_user: {str(e)}")
+        current_app.logger.error(f"Error in update_user: {str(e)}")
         return jsonify({'message': f'Error updating user: {str(e)}'}), 500
 
 # Plan endpoints
-@app.route('/plans', methods=['GET'])
+# Serialized public catalog: {'version', 'body', 'etag'}
+plan_catalog_cache = {}
+
+def invalidate_plan_catalog():
+    version_store.bump('plans')
+
+def get_plan_catalog():
+    version = version_store.get('plans')
+    cached = plan_catalog_cache.get('catalog')
+    if cached and cached['version'] == version:
+        return cached
+
+    with primary_reads():
+        body = dumps_json(PLAN_PROJECTION.fetch(
+            PLAN_PUBLIC_FIELDS, Plan.is_active == True, order_by=Plan.id
+        ))
+    cached = {
+        'version': version,
+        'body': body,
+        'etag': hashlib.sha256(body).hexdigest()
+    }
+    plan_catalog_cache['catalog'] = cached
+    return cached
+
+def get_plan_info(plan_id):
+    """Return (id, name, price, duration_days) for a plan, or None.
+
+    Read by primary key on every call: a per-process copy would miss plans
+    created or edited by other workers.
+    """
+    return db.session.execute(
+        db.select(Plan.id, Plan.name, Plan.price, Plan.duration_days).where(Plan.id == plan_id)
+    ).first()
+
+@bp.route('/plans', methods=['GET'])
 def get_plans():
-    plans = Plan.query.filter_by(is_active=True).all()
-    return jsonify([{
-        'id': plan.id,
-        'name': plan.name,
-        'description': plan.description,
-        'price': plan.price,
-        'duration_days': plan.duration_days,
-        'features': plan.features
-    } for plan in plans]), 200
+    catalog = get_plan_catalog()
+    response = Response(catalog['body'], mimetype='application/json')
+    # Weak: the body may be sent gzip- or brotli-encoded (compress_response)
+    response.set_etag(catalog['etag'], weak=True)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 # Get all plans including inactive ones (for admin)
-@app.route('/plans/all', methods=['GET'])
-@jwt_required()
+@bp.route('/plans/all', methods=['GET'])
+@admin_required
+@conditional('plan')
 def get_all_plans():
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get_or_404(int(current_user_id))
-        
-        if current_user.role != 'admin':
-            return jsonify({'message': 'Unauthorized'}), 403
-            
-        plans = Plan.query.all()
-        return jsonify([{
-            'id': plan.id,
-            'name': plan.name,
-            'description': plan.description,
-            'price': plan.price,
-            'duration_days': plan.duration_days,
-            'features': plan.features,
-            'is_active': plan.is_active
-        } for plan in plans]), 200
+        try:
+            fields = PLAN_PROJECTION.parse_fields(request.args.get('fields'), PLAN_FIELDS)
+        except ValueError as e:
+            return jsonify({'message': f'Invalid query parameter: {str(e)}'}), 400
+        return json_response(PLAN_PROJECTION.fetch(fields, order_by=Plan.id))
     except Exception as e:
-        app.logger.error(f"Error in get_all_plans: {str(e)}")
+        current_app.logger.error(f"Error in get_all_plans: {str(e)}")
         return jsonify({'message': f'Error retrieving plans: {str(e)}'}), 500
 
-@app.route('/plans', methods=['POST'])
-@jwt_required()
+@bp.route('/plans', methods=['POST'])
+@admin_required
 def create_plan():
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get_or_404(int(current_user_id))
-        
-        if current_user.role != 'admin':
-            return jsonify({'message': 'Unauthorized'}), 403
-            
         data = request.get_json()
         
         # Check if a plan with this name already exists
@@ -302,31 +1625,22 @@ def create_plan():
         )
         
         db.session.add(plan)
+        db.session.flush()
+        record_change('plan', plan.id, 'created', PLAN_PROJECTION.serialize_object(plan, PLAN_FIELDS))
         db.session.commit()
+        change_notifier.notify()
+        invalidate_plan_catalog()
         
-        return jsonify({
-            'id': plan.id,
-            'name': plan.name,
-            'description': plan.description,
-            'price': plan.price,
-            'duration_days': plan.duration_days,
-            'features': plan.features
-        }), 201
+        return json_response(PLAN_PROJECTION.serialize_object(plan, PLAN_PUBLIC_FIELDS), 201)
     except Exception as e:
-        app.logger.error(f"Error in create_plan: {str(e)}")
+        current_app.logger.error(f"Error in create_plan: {str(e)}")
         return jsonify({'message': f'Error creating plan: {str(e)}'}), 500
 
 # Update plan
-@app.route('/plans/<int:id>', methods=['PUT'])
-@jwt_required()
+@bp.route('/plans/<int:id>', methods=['PUT'])
+@admin_required
 def update_plan(id):
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get_or_404(int(current_user_id))
-        
-        if current_user.role != 'admin':
-            return jsonify({'message': 'Unauthorized'}), 403
-            
         plan = Plan.query.get_or_404(id)
         data = request.get_json()
         
@@ -348,32 +1662,21 @@ def update_plan(id):
         if 'is_active' in data:
             plan.is_active = data['is_active']
         
+        record_change('plan', id, 'updated', PLAN_PROJECTION.serialize_object(plan, PLAN_FIELDS))
         db.session.commit()
+        change_notifier.notify()
+        invalidate_plan_catalog()
         
-        return jsonify({
-            'id': plan.id,
-            'name': plan.name,
-            'description': plan.description,
-            'price': plan.price,
-            'duration_days': plan.duration_days,
-            'features': plan.features,
-            'is_active': plan.is_active
-        }), 200
+        return json_response(PLAN_PROJECTION.serialize_object(plan, PLAN_FIELDS))
     except Exception as e:
-        app.logger.error(f"Error in update_plan: {str(e)}")
+        current_app.logger.error(f"Error in update_plan: {str(e)}")
         return jsonify({'message': f'Error updating plan: {str(e)}'}), 500
 
 # Patch plan (partial update)
-@app.route('/plans/<int:id>', methods=['PATCH'])
-@jwt_required()
+@bp.route('/plans/<int:id>', methods=['PATCH'])
+@admin_required
 def patch_plan(id):
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get_or_404(int(current_user_id))
-        
-        if current_user.role != 'admin':
-            return jsonify({'message': 'Unauthorized'}), 403
-            
         plan = Plan.query.get_or_404(id)
         data = request.get_json()
         
@@ -395,178 +1698,1807 @@ def patch_plan(id):
         if 'is_active' in data:
             plan.is_active = data['is_active']
         
+        record_change('plan', id, 'updated', PLAN_PROJECTION.serialize_object(plan, PLAN_FIELDS))
         db.session.commit()
+        change_notifier.notify()
+        invalidate_plan_catalog()
         
-        return jsonify({
-            'id': plan.id,
-            'name': plan.name,
-            'description': plan.description,
-            'price': plan.price,
-            'duration_days': plan.duration_days,
-            'features': plan.features,
-            'is_active': plan.is_active
-        }), 200
+        return json_response(PLAN_PROJECTION.serialize_object(plan, PLAN_FIELDS))
     except Exception as e:
-        app.logger.error(f"Error in patch_plan: {str(e)}")
+        current_app.logger.error(f"Error in patch_plan: {str(e)}")
         return jsonify({'message': f'Error updating plan: {str(e)}'}), 500
 
 # Delete plan
-@app.route('/plans/<int:id>', methods=['DELETE'])
-@jwt_required()
+@bp.route('/plans/<int:id>', methods=['DELETE'])
+@admin_required
 def delete_plan(id):
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get_or_404(int(current_user_id))
-        
-        if current_user.role != 'admin':
-            return jsonify({'message': 'Unauthorized'}), 403
-            
         plan = Plan.query.get_or_404(id)
         db.session.delete(plan)
+        PlanStats.query.filter_by(plan_id=id).delete()
+        record_change('plan', id, 'deleted', {'id': id})
         db.session.commit()
+        change_notifier.notify()
+        invalidate_plan_catalog()
         
         return jsonify({'message': 'Plan deleted successfully'}), 200
     except Exception as e:
-        app.logger.error(f"Error in delete_plan: {str(e)}")
+        current_app.logger.error(f"Error in delete_plan: {str(e)}")
         return jsonify({'message': f'Error deleting plan: {str(e)}'}), 500
 
 # Subscription endpoints
-@app.route('/subscriptions', methods=['POST'])
+def insert_subscription(user_id, plan, now):
+    """Insert an active subscription unless one exists; returns the new row or None."""
+    statement = dialect_insert(Subscription).values(
+        user_id=user_id,
+        plan_id=plan.id,
+        start_date=now,
+        end_date=now + timedelta(days=plan.duration_days),
+        is_active=True,
+        created_at=now
+    ).on_conflict_do_nothing(
+        index_elements=['user_id', 'plan_id'],
+        index_where=Subscription.is_active == True
+    ).returning(Subscription.id, Subscription.user_id, Subscription.plan_id,
+                Subscription.start_date, Subscription.end_date, Subscription.is_active)
+    return db.session.execute(statement).first()
+
+@bp.route('/subscriptions', methods=['POST'])
 @jwt_required()
+@idempotent
 def create_subscription():
     try:
         data = request.get_json()
-        user_id = get_jwt_identity()
+        user_id = int(get_jwt_identity())
         
-        # Debug info
-        print(f"Creating subscription - User ID: {user_id}, Plan ID: {data.get('plan_id')}")
+        current_app.logger.debug(f"Creating subscription - User ID: {user_id}, Plan ID: {data.get('plan_id')}")
         
-        plan = Plan.query.get_or_404(int(data['plan_id']))
+        plan = get_plan_info(int(data['plan_id']))
+        if plan is None:
+            return jsonify({'message': 'Plan not found'}), 404
         
-        # Check if user already has an active subscription to this plan
-        existing_subscription = Subscription.query.filter_by(
-            user_id=int(user_id), 
-            plan_id=data['plan_id'], 
-            is_active=True
-        ).first()
+        # The partial unique index rejects a second active subscription to the
+        # plan; an expired one not yet swept is retired and the insert retried
+        now = datetime.utcnow()
+        subscription = insert_subscription(user_id, plan, now)
+        if subscription is None and deactivate_expired_subscriptions(
+            Subscription.user_id == user_id, Subscription.plan_id == plan.id, now=now
+        ):
+            subscription = insert_subscription(user_id, plan, now)
         
-        if existing_subscription and not existing_subscription.is_expired():
+        if subscription is None:
+            db.session.rollback()
             return jsonify({
                 'message': 'You already have an active subscription to this plan'
             }), 400
         
-        end_date = datetime.utcnow() + timedelta(days=plan.duration_days)
-        
-        subscription = Subscription(
-            user_id=int(user_id),  
-            plan_id=data['plan_id'],
-            end_date=end_date
-        )
-        
-        db.session.add(subscription)
+        track_subscriptions_created(plan.id, plan.price)
+        record_change('subscription', subscription.id, 'created', subscription_change(subscription))
         db.session.commit()
+        change_notifier.notify()
+        invalidate_subscriptions(user_id)
         
         return jsonify({
             'id': subscription.id,
-            'plan_id': subscription.plan_id,
+            'plan_id': plan.id,
             'plan_name': plan.name,
             'start_date': subscription.start_date.isoformat(),
             'end_date': subscription.end_date.isoformat(),
             'is_active': subscription.is_active
         }), 201
     except Exception as e:
-        app.logger.error(f"Error in create_subscription: {str(e)}")
+        db.session.rollback()
+        current_app.logger.error(f"Error in create_subscription: {str(e)}")
         return jsonify({'message': f'Error creating subscription: {str(e)}'}), 500
 
-@app.route('/subscriptions', methods=['GET'])
+# Serialized GET /subscriptions bodies; sized from the app settings by create_app
+subscription_list_cache = ExpiringLRUCache(10000, 300)
+
+def invalidate_subscriptions(*user_ids):
+    """Bump the subscriptions version of users whose subscriptions changed.
+
+    Their cached subscription lists and entitlements are keyed on it, so
+    every worker recompiles them.
+    """
+    if user_ids:
+        version_store.bump_many([f'subscriptions:{user_id}' for user_id in set(user_ids)])
+
+def get_subscription_list(user_id, fields):
+    """A user's serialized subscription list, cached until it changes.
+
+    The key includes the user's list version and the plans version, so
+    writes and plan renames in any worker miss the old entry. Entries
+    expire at the earliest end_date still ahead, when is_active flips.
+    """
+    key = (user_id, tuple(fields), version_store.get('plans'),
+           version_store.get(f'subscriptions:{user_id}'))
+    body = subscription_list_cache.get(key)
+    if body is not None:
+        return body
+
+    now = datetime.utcnow()
+    with primary_reads():
+        body = dumps_json(SUBSCRIPTION_PROJECTION.fetch(
+            fields, Subscription.user_id == user_id, order_by=Subscription.id
+        ))
+        expires_at = db.session.execute(
+            db.select(db.func.min(Subscription.end_date))
+            .where(Subscription.user_id == user_id,
+                   Subscription.is_active == True,
+                   Subscription.end_date >= now)
+        ).scalar()
+    subscription_list_cache.set(key, body, expires_at)
+    return body
+
+@bp.route('/subscriptions', methods=['GET'])
 @jwt_required()
 def get_user_subscriptions():
     try:
         user_id = get_jwt_identity()
-        subscriptions = Subscription.query.filter_by(user_id=int(user_id)).all()
+        try:
+            fields = SUBSCRIPTION_PROJECTION.parse_fields(request.args.get('fields'), SUBSCRIPTION_FIELDS)
+        except ValueError as e:
+            return jsonify({'message': f'Invalid query parameter: {str(e)}'}), 400
         
-        return jsonify([{
-            'id': sub.id,
-            'plan_id': sub.plan_id,
-            'plan_name': sub.plan.name,
-            'start_date': sub.start_date.isoformat(),
-            'end_date': sub.end_date.isoformat(),
-            'is_active': sub.is_active and not sub.is_expired()
-        } for sub in subscriptions]), 200
+        return Response(get_subscription_list(int(user_id), fields), mimetype='application/json')
     except Exception as e:
-        app.logger.error(f"Error in get_user_subscriptions: {str(e)}")
+        current_app.logger.error(f"Error in get_user_subscriptions: {str(e)}")
         return jsonify({'message': f'Error retrieving subscriptions: {str(e)}'}), 500
 
-@app.route('/subscriptions/all', methods=['GET'])
-@jwt_required()
+def subscription_list_metrics():
+    return [
+        '# HELP subscription_list_cache_hits_total Subscription list cache hits.',
+        '# TYPE subscription_list_cache_hits_total counter',
+        f'subscription_list_cache_hits_total {subscription_list_cache.hits}',
+        '# HELP subscription_list_cache_misses_total Subscription list cache misses.',
+        '# TYPE subscription_list_cache_misses_total counter',
+        f'subscription_list_cache_misses_total {subscription_list_cache.misses}',
+        '# HELP subscription_list_cache_entries Subscription list cache size.',
+        '# TYPE subscription_list_cache_entries gauge',
+        f'subscription_list_cache_entries {len(subscription_list_cache)}'
+    ]
+
+metrics_collectors.append(subscription_list_metrics)
+
+# Page size limits for the admin subscription listing
+SUBSCRIPTIONS_PAGE_SIZE_MAX = 1000
+SUBSCRIPTIONS_STREAM_BATCH = 1000
+
+def parse_bool_arg(value):
+    if value is None:
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValueError(f'invalid boolean: {value}')
+
+def parse_datetime_arg(value):
+    return datetime.fromisoformat(value) if value else None
+
+def parse_int_arg(value):
+    return int(value) if value else None
+
+def subscription_filters(args):
+    """Build filter clauses for the admin subscription listing from query args.
+
+    Subscriptions of soft-deleted users are always excluded; their ids come
+    from a search on the user is_deleted index.
+    """
+    filters = [Subscription.user_id.not_in(
+        db.select(User.id).where(User.is_deleted == True)
+    )]
+    if args.get('user_id'):
+        filters.append(Subscription.user_id == int(args['user_id']))
+    if args.get('plan_id'):
+        filters.append(Subscription.plan_id == int(args['plan_id']))
+
+    active = parse_bool_arg(args.get('active'))
+    now = datetime.utcnow()
+    if active is True:
+        filters.append(db.and_(Subscription.is_active == True, Subscription.end_date >= now))
+    elif active is False:
+        filters.append(db.or_(Subscription.is_active == False, Subscription.end_date < now))
+
+    end_after = parse_datetime_arg(args.get('end_after'))
+    if end_after:
+        filters.append(Subscription.end_date >= end_after)
+    end_before = parse_datetime_arg(args.get('end_before'))
+    if end_before:
+        filters.append(Subscription.end_date < end_before)
+    return filters
+
+def stream_subscriptions(fields, filters):
+    """Yield subscriptions as NDJSON lines from a server-side cursor."""
+    query = SUBSCRIPTION_PROJECTION.select(fields) \
+        .where(*filters) \
+        .order_by(Subscription.id) \
+        .execution_options(stream_results=True, yield_per=SUBSCRIPTIONS_STREAM_BATCH)
+
+    try:
+        result = db.session.execute(query, {'now': datetime.utcnow()})
+        for rows in result.partitions():
+            yield b''.join(dumps_json(item) + b'\n'
+                           for item in SUBSCRIPTION_PROJECTION.serialize(rows, fields))
+    except Exception as e:
+        current_app.logger.error(f"Error in stream_subscriptions: {str(e)}")
+
+# (table versions, next end_date) for conditional subscription listings
+subscription_expiry_cache = {}
+
+def next_subscription_expiry(versions):
+    """Earliest end_date still ahead among active subscriptions.
+
+    is_active in the listings flips at that time without a write. Kept
+    per table versions, so it is only queried again after a write or once
+    that time has passed.
+    """
+    now = datetime.utcnow()
+    cached = subscription_expiry_cache.get('next')
+    if cached and cached[0] == versions and (cached[1] is None or cached[1] > now):
+        return cached[1]
+    expires_at = db.session.execute(
+        db.select(db.func.min(Subscription.end_date))
+        .where(Subscription.is_active == True, Subscription.end_date >= now)
+    ).scalar()
+    subscription_expiry_cache['next'] = (versions, expires_at)
+    return expires_at
+
+@bp.route('/subscriptions/all', methods=['GET'])
+@admin_required
+@conditional('subscription', 'user', 'plan', valid_until=next_subscription_expiry)
 def get_all_subscriptions():
+    """List all subscriptions (admin).
+
+    Optional query args: user_id, plan_id, active, end_after, end_before,
+    and `fields` for a sparse fieldset. Pass `limit` (and `cursor` from the
+    previous page) for keyset pagination, or `stream=1` /
+    `Accept: application/x-ndjson` for an NDJSON stream.
+    """
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get_or_404(int(current_user_id))
-        
-        if current_user.role != 'admin':
-            return jsonify({'message': 'Unauthorized'}), 403
-            
-        subscriptions = Subscription.query.all()
-        
-        return jsonify([{
-            'id': sub.id,
-            'user_id': sub.user_id,
-            'username': sub.user.username,
-            'plan_id': sub.plan_id,
-            'plan_name': sub.plan.name,
-            'start_date': sub.start_date.isoformat(),
-            'end_date': sub.end_date.isoformat(),
-            'is_active': sub.is_active and not sub.is_expired()
-        } for sub in subscriptions]), 200
+        try:
+            filters = subscription_filters(request.args)
+            fields = SUBSCRIPTION_PROJECTION.parse_fields(
+                request.args.get('fields'), SUBSCRIPTION_ADMIN_FIELDS)
+            stream = parse_bool_arg(request.args.get('stream'))
+            limit = parse_int_arg(request.args.get('limit'))
+            cursor = parse_int_arg(request.args.get('cursor'))
+        except ValueError as e:
+            return jsonify({'message': f'Invalid query parameter: {str(e)}'}), 400
+
+        if stream or request.accept_mimetypes.best == 'application/x-ndjson':
+            return Response(
+                stream_with_context(stream_subscriptions(fields, filters)),
+                mimetype='application/x-ndjson'
+            )
+
+        if limit is None:
+            return json_response(SUBSCRIPTION_PROJECTION.fetch(
+                fields, *filters, order_by=Subscription.id))
+
+        limit = max(1, min(limit, SUBSCRIPTIONS_PAGE_SIZE_MAX))
+        if 'id' not in fields:
+            fields.append('id')  # needed for the next cursor
+        if cursor is not None:
+            filters.append(Subscription.id > cursor)
+        items = SUBSCRIPTION_PROJECTION.fetch(
+            fields, *filters, order_by=Subscription.id, limit=limit)
+
+        next_cursor = items[-1]['id'] if len(items) == limit else None
+        return json_response({'items': items, 'next_cursor': next_cursor})
     except Exception as e:
-        app.logger.error(f"Error in get_all_subscriptions: {str(e)}")
+        current_app.logger.error(f"Error in get_all_subscriptions: {str(e)}")
         return jsonify({'message': f'Error retrieving subscriptions: {str(e)}'}), 500
 
 # Cancel subscription (set is_active to False)
-@app.route('/subscriptions/<int:id>', methods=['DELETE'])
+@bp.route('/subscriptions/<int:id>', methods=['DELETE'])
 @jwt_required()
 def cancel_subscription(id):
     try:
         user_id = get_jwt_identity()
         subscription = Subscription.query.get_or_404(id)
         
-        current_user = User.query.get(int(user_id))
-        if current_user.role != 'admin' and subscription.user_id != int(user_id):
+        if get_jwt().get('role') != 'admin' and subscription.user_id != int(user_id):
             return jsonify({'message': 'Unauthorized'}), 403
         
         # If subscription is active, just set it to inactive (cancel)    
         if subscription.is_active:
             subscription.is_active = False
+            subscription.cancelled_at = datetime.utcnow()
+            track_subscriptions_deactivated(subscription.plan_id, cancelled=True)
+            record_change('subscription', id, 'cancelled', subscription_change(subscription))
             db.session.commit()
+            change_notifier.notify()
+            invalidate_subscriptions(subscription.user_id)
             
             return jsonify({'message': 'Subscription canceled successfully'}), 200
         else:
             # If already inactive, actually delete it
+            record_change('subscription', id, 'deleted', subscription_change(subscription))
             db.session.delete(subscription)
             db.session.commit()
+            change_notifier.notify()
+            invalidate_subscriptions(subscription.user_id)
             
             return jsonify({'message': 'Subscription deleted successfully'}), 200
             
     except Exception as e:
-        app.logger.error(f"Error in cancel_subscription: {str(e)}")
+        current_app.logger.error(f"Error in cancel_subscription: {str(e)}")
         return jsonify({'message': f'Error with subscription: {str(e)}'}), 500
 
+# Search
+# FTS5 index over usernames and emails, kept in sync with the user table by
+# triggers (SQLite). Other databases fall back to prefix matches.
+USER_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5("
+    "username, email, content='user', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS user_search_insert AFTER INSERT ON user BEGIN "
+    "INSERT INTO user_search (rowid, username, email) VALUES (new.id, new.username, new.email); END",
+    "CREATE TRIGGER IF NOT EXISTS user_search_delete AFTER DELETE ON user BEGIN "
+    "INSERT INTO user_search (user_search, rowid, username, email) "
+    "VALUES ('delete', old.id, old.username, old.email); END",
+    "CREATE TRIGGER IF NOT EXISTS user_search_update AFTER UPDATE OF username, email ON user BEGIN "
+    "INSERT INTO user_search (user_search, rowid, username, email) "
+    "VALUES ('delete', old.id, old.username, old.email); "
+    "INSERT INTO user_search (rowid, username, email) VALUES (new.id, new.username, new.email); END",
+)
+USER_SEARCH = db.table('user_search', db.column('rowid'), db.column('user_search'))
+SEARCH_PAGE_SIZE_DEFAULT = 20
+SEARCH_PAGE_SIZE_MAX = 100
+
+def create_search_index():
+    """Create the user search index and its triggers, filling it if new."""
+    if db.engine.dialect.name != 'sqlite':
+        return
+    exists = db.inspect(db.engine).has_table('user_search')
+    with db.engine.begin() as conn:
+        for ddl in USER_SEARCH_DDL:
+            conn.execute(db.text(ddl))
+        if not exists:
+            conn.execute(db.text("INSERT INTO user_search (user_search) VALUES ('rebuild')"))
+
+def parse_search_terms(value):
+    terms = re.findall(r'\w+', value or '')
+    if not terms:
+        raise ValueError('q must contain at least one letter or digit')
+    return terms
+
+def match_users(statement, terms, user_id_column):
+    """Restrict `statement` to users whose username or email has a word
+    starting with every term, best matches (by bm25, username first) first."""
+    if db.engine.dialect.name == 'sqlite':
+        match = ' '.join(f'"{term}"*' for term in terms)
+        return (statement
+                .join(USER_SEARCH, USER_SEARCH.c.rowid == user_id_column)
+                .where(USER_SEARCH.c.user_search.op('MATCH')(match))
+                .order_by(db.func.bm25(db.literal_column('user_search'), 2.0, 1.0)))
+    matched = db.select(User.id).where(*(
+        db.or_(User.username.ilike(f'{term}%'), User.email.ilike(f'{term}%')) for term in terms
+    ))
+    return statement.where(user_id_column.in_(matched))
+
+def parse_page_args(args):
+    limit = parse_int_arg(args.get('limit'))
+    cursor = parse_int_arg(args.get('cursor'))
+    if limit is None:
+        limit = SEARCH_PAGE_SIZE_DEFAULT
+    if cursor is None:
+        cursor = 0
+    return max(1, min(limit, SEARCH_PAGE_SIZE_MAX)), max(0, cursor)
+
+def search_page(projection, statement, fields, limit, cursor):
+    """Run a ranked search statement for one page; the cursor is an offset."""
+    rows = db.session.execute(statement.limit(limit).offset(cursor), {'now': datetime.utcnow()})
+    items = projection.serialize(rows, fields)
+    return {'items': items, 'next_cursor': cursor + limit if len(items) == limit else None}
+
+@bp.route('/users/search', methods=['GET'])
+@admin_required
+def search_users():
+    """Ranked prefix search over usernames and emails (admin).
+
+    Query args: q (required), role, fields, and limit/cursor for paging.
+    """
+    try:
+        try:
+            terms = parse_search_terms(request.args.get('q'))
+            fields = USER_PROJECTION.parse_fields(request.args.get('fields'), USER_FIELDS)
+            limit, cursor = parse_page_args(request.args)
+        except ValueError as e:
+            return jsonify({'message': f'Invalid query parameter: {str(e)}'}), 400
+
+        statement = match_users(USER_PROJECTION.select(fields), terms, User.id).where(User.is_deleted == False)
+        if request.args.get('role'):
+            statement = statement.where(User.role == request.args['role'])
+        statement = statement.order_by(User.id)
+        return json_response(search_page(USER_PROJECTION, statement, fields, limit, cursor))
+    except Exception as e:
+        current_app.logger.error(f"Error in search_users: {str(e)}")
+        return jsonify({'message': f'Error searching users: {str(e)}'}), 500
+
+@bp.route('/subscriptions/search', methods=['GET'])
+@admin_required
+def search_subscriptions():
+    """Subscriptions of users matching `q`, best matching users first (admin).
+
+    Accepts the filters of GET /subscriptions/all (plan_id, active, ...),
+    fields, and limit/cursor for paging.
+    """
+    try:
+        try:
+            terms = parse_search_terms(request.args.get('q'))
+            filters = subscription_filters(request.args)
+            fields = SUBSCRIPTION_PROJECTION.parse_fields(
+                request.args.get('fields'), SUBSCRIPTION_ADMIN_FIELDS)
+            limit, cursor = parse_page_args(request.args)
+        except ValueError as e:
+            return jsonify({'message': f'Invalid query parameter: {str(e)}'}), 400
+
+        statement = match_users(SUBSCRIPTION_PROJECTION.select(fields), terms, Subscription.user_id)
+        statement = statement.where(*filters).order_by(Subscription.id)
+        return json_response(search_page(SUBSCRIPTION_PROJECTION, statement, fields, limit, cursor))
+    except Exception as e:
+        current_app.logger.error(f"Error in search_subscriptions: {str(e)}")
+        return jsonify({'message': f'Error searching subscriptions: {str(e)}'}), 500
+
+# Change feed
+CHANGES_PAGE_SIZE_DEFAULT = 100
+CHANGES_PAGE_SIZE_MAX = 1000
+# Longest a GET /changes request may wait for a change, in seconds
+CHANGES_WAIT_MAX = 30
+# Outbox rows deleted per transaction by compact_changes
+CHANGES_COMPACT_BATCH = 5000
+SUBSCRIPTION_CHANGE_FIELDS = ('id', 'user_id', 'plan_id', 'start_date', 'end_date',
+                              'is_active', 'cancelled_at')
+# pg_advisory_xact_lock key held by transactions writing to the outbox
+CHANGE_LOCK_KEY = 0x6368616e6765
+
+class ChangeNotifier:
+    """Wakes this process's change readers when a change is committed."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._generation = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def notify(self):
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """Wait until notify() has been called since `generation` was read."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._generation != generation, timeout)
+
+change_notifier = ChangeNotifier()
+
+def lock_changes():
+    """Serialize outbox writers on PostgreSQL until the transaction ends.
+
+    Readers page by id, but a sequence hands out ids at INSERT while rows
+    become visible at COMMIT; a reader could see id 11 before id 10 commits
+    and skip it for good. Holding one advisory lock from the first outbox
+    insert to the commit makes ids visible in order. SQLite has a single
+    writer, so ids already commit in order.
+    """
+    if db.engine.dialect.name == 'postgresql' and not db.session.info.get('change_lock'):
+        db.session.execute(db.text('SELECT pg_advisory_xact_lock(:key)'), {'key': CHANGE_LOCK_KEY})
+        db.session.info['change_lock'] = True
+
+def record_change(entity, entity_id, action, data):
+    """Add a change to the outbox as part of the current transaction.
+
+    Call change_notifier.notify() once the transaction has committed.
+    """
+    lock_changes()
+    db.session.add(ChangeEvent(
+        entity=entity, entity_id=entity_id, action=action, data=dumps_json(data).decode()
+    ))
+
+def record_changes(entity, action, changes):
+    """Insert (entity_id, data) changes to the outbox in one statement; see record_change."""
+    if changes:
+        lock_changes()
+        # Table-level insert: skips the ORM's per-row bulk bookkeeping
+        db.session.execute(db.insert(ChangeEvent.__table__), [{
+            'entity': entity, 'entity_id': entity_id, 'action': action,
+            'data': dumps_json(data).decode(), 'created_at': datetime.utcnow()
+        } for entity_id, data in changes])
+
+def subscription_change(subscription, **values):
+    """Snapshot of a subscription (model, row or dict of columns) for its outbox entry."""
+    if isinstance(subscription, dict):
+        data = {name: subscription.get(name) for name in SUBSCRIPTION_CHANGE_FIELDS}
+    else:
+        data = {name: getattr(subscription, name, None) for name in SUBSCRIPTION_CHANGE_FIELDS}
+    data.update(values)
+    data['start_date'] = isoformat(data['start_date'])
+    data['end_date'] = isoformat(data['end_date'])
+    data['cancelled_at'] = isoformat(data['cancelled_at'])
+    return data
+
+def fetch_changes(since, limit):
+    rows = db.session.execute(
+        db.select(ChangeEvent)
+        .where(ChangeEvent.id > since)
+        .order_by(ChangeEvent.id)
+        .limit(limit)
+    ).scalars()
+    return [{
+        'id': change.id,
+        'event': f'{change.entity}.{change.action}',
+        'entity': change.entity,
+        'entity_id': change.entity_id,
+        'data': json.loads(change.data),
+        'created_at': change.created_at.isoformat()
+    } for change in rows]
+
+def wait_for_changes(since, limit, timeout):
+    """Changes after `since`, waiting up to `timeout` seconds for the first one.
+
+    Commits in this process wake the wait right away; changes from other
+    processes are picked up by re-reading every CHANGES_POLL_INTERVAL seconds.
+    The database connection is released while waiting.
+    """
+    interval = current_app.config['CHANGES_POLL_INTERVAL']
+    deadline = time.monotonic() + timeout
+    while True:
+        generation = change_notifier.generation
+        changes = fetch_changes(since, limit)
+        db.session.close()
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        change_notifier.wait(generation, min(interval, remaining))
+
+def format_change_event(change):
+    return (f"id: {change['id']}\nevent: {change['event']}\ndata: ".encode()
+            + dumps_json(change) + b'\n\n')
+
+def stream_change_events(since):
+    """Yield server-sent events for changes after `since`, with keep-alives."""
+    keepalive = current_app.config['CHANGES_KEEPALIVE']
+    try:
+        while True:
+            changes = wait_for_changes(since, CHANGES_PAGE_SIZE_MAX, keepalive)
+            if changes:
+                since = changes[-1]['id']
+                yield b''.join(format_change_event(change) for change in changes)
+            else:
+                yield b': keep-alive\n\n'
+    except Exception as e:
+        current_app.logger.error(f"Error in stream_change_events: {str(e)}")
+
+@bp.route('/changes', methods=['GET'])
+@admin_required
+def get_changes():
+    """Subscription, plan and user changes after a cursor (admin).
+
+    Pass `since` (0 for the oldest retained change) and `limit`; continue
+    from `next_cursor`. With `wait` (seconds) an empty result is held open
+    until a change arrives, for long polling.
+    """
+    try:
+        try:
+            since = int(request.args.get('since', 0))
+            limit = int(request.args.get('limit', CHANGES_PAGE_SIZE_DEFAULT))
+            wait = float(request.args.get('wait', 0))
+        except ValueError as e:
+            return jsonify({'message': f'Invalid query parameter: {str(e)}'}), 400
+
+        limit = max(1, min(limit, CHANGES_PAGE_SIZE_MAX))
+        wait = max(0.0, min(wait, CHANGES_WAIT_MAX))
+        changes = wait_for_changes(since, limit, wait)
+        next_cursor = changes[-1]['id'] if changes else since
+        return json_response({'items': changes, 'next_cursor': next_cursor})
+    except Exception as e:
+        current_app.logger.error(f"Error in get_changes: {str(e)}")
+        return jsonify({'message': f'Error retrieving changes: {str(e)}'}), 500
+
+@bp.route('/changes/stream', methods=['GET'])
+@admin_required
+def stream_changes():
+    """Server-sent event stream of changes (admin).
+
+    Starts after the Last-Event-ID header when a client reconnects,
+    otherwise after `since`. Each event's id is its cursor.
+    """
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+    except ValueError as e:
+        return jsonify({'message': f'Invalid cursor: {str(e)}'}), 400
+
+    response = Response(stream_with_context(stream_change_events(since)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def delete_changes(before, *criteria):
+    """Delete changes created before `before` that match `criteria`.
+
+    Walks the id range in CHANGES_COMPACT_BATCH steps, one short write
+    transaction per step; ids grow with created_at, so the range ends at
+    the newest change older than `before`.
+    """
+    low, high = db.session.execute(
+        db.select(db.func.min(ChangeEvent.id) - 1, db.func.max(ChangeEvent.id))
+        .where(ChangeEvent.created_at < before)
+    ).one()
+    deleted = 0
+    while high is not None and low < high:
+        step = min(low + CHANGES_COMPACT_BATCH, high)
+        result = db.session.execute(
+            db.delete(ChangeEvent).where(
+                ChangeEvent.id > low, ChangeEvent.id <= step,
+                ChangeEvent.created_at < before, *criteria
+            )
+        )
+        db.session.commit()
+        deleted += result.rowcount
+        low = step
+    return deleted
+
+def compact_changes(now=None):
+    """Apply outbox retention and compaction; returns the deleted row counts.
+
+    Changes older than CHANGE_RETENTION_HOURS are deleted. Changes older than
+    CHANGE_COMPACT_AFTER_HOURS are deleted when the same entity has a newer
+    change, so a consumer catching up from an old cursor still receives
+    each entity's latest state.
+    """
+    now = now or datetime.utcnow()
+    config = current_app.config
+    expired = delete_changes(now - timedelta(hours=config['CHANGE_RETENTION_HOURS']))
+
+    superseded = 0
+    if config['CHANGE_COMPACT_AFTER_HOURS'] > 0:
+        newer = db.aliased(ChangeEvent)
+        superseded = delete_changes(
+            now - timedelta(hours=config['CHANGE_COMPACT_AFTER_HOURS']),
+            db.select(newer.id).where(
+                newer.entity == ChangeEvent.entity,
+                newer.entity_id == ChangeEvent.entity_id,
+                newer.id > ChangeEvent.id
+            ).exists()
+        )
+    return {'expired': expired, 'superseded': superseded}
+
+@bp.cli.command('compact-changes')
+def compact_changes_command():
+    """Delete expired and superseded change feed entries."""
+    click.echo(json.dumps(compact_changes()))
+
+# Entitlements
+# Sized from the app settings by create_app
+entitlement_cache = ExpiringLRUCache(100000, 30)
+
+def parse_features(features):
+    """Plan.features is a comma-separated list, as rendered by the frontend."""
+    return [feature.strip() for feature in (features or '').split(',') if feature.strip()]
+
+def load_entitlements(user_ids):
+    """Compile {user_id: (features, expires_at)} for users missing from the cache.
+
+    Entries are tagged with the plans version and the user's subscriptions
+    version, so plan and subscription changes invalidate them in every
+    worker, and expire when the first subscription ends.
+    """
+    plans_version = version_store.get('plans')
+    versions = {}
+    result = {}
+    missing = []
+    for user_id in user_ids:
+        versions[user_id] = (plans_version, version_store.get(f'subscriptions:{user_id}'))
+        entry = entitlement_cache.get(user_id)
+        if entry is not None and entry[0] == versions[user_id]:
+            result[user_id] = entry[1:]
+        else:
+            missing.append(user_id)
+    if not missing:
+        return result
+
+    now = datetime.utcnow()
+    compiled = {user_id: (set(), None) for user_id in missing}
+    with primary_reads():
+        rows = db.session.execute(
+            db.select(Subscription.user_id, Subscription.end_date, Plan.features)
+            .join(Plan, Subscription.plan_id == Plan.id)
+            .where(Subscription.user_id.in_(missing),
+                   Subscription.is_active == True,
+                   Subscription.end_date >= now)
+        ).all()
+    for user_id, end_date, features in rows:
+        feature_set, expires_at = compiled[user_id]
+        feature_set.update(parse_features(features))
+        compiled[user_id] = (feature_set, min(expires_at, end_date) if expires_at else end_date)
+
+    for user_id, (feature_set, expires_at) in compiled.items():
+        features = sorted(feature_set)
+        entitlement_cache.set(user_id, (versions[user_id], features, expires_at), expires_at)
+        result[user_id] = (features, expires_at)
+    return result
+
+def serialize_entitlements(user_id, features, expires_at, feature=None):
+    data = {
+        'user_id': user_id,
+        'features': features,
+        'expires_at': expires_at.isoformat() if expires_at else None
+    }
+    if feature is not None:
+        data['feature'] = feature
+        data['allowed'] = feature in features
+    return data
+
+@bp.route('/entitlements/<int:user_id>', methods=['GET'])
+@jwt_required()
+def get_entitlements(user_id):
+    """Features granted by the user's active subscriptions.
+
+    Pass `feature` to also get an `allowed` flag for that feature.
+    """
+    try:
+        if get_jwt().get('role') != 'admin' and int(get_jwt_identity()) != user_id:
+            return jsonify({'message': 'Unauthorized'}), 403
+        features, expires_at = load_entitlements([user_id])[user_id]
+        return jsonify(serialize_entitlements(
+            user_id, features, expires_at, request.args.get('feature')
+        )), 200
+    except Exception as e:
+        current_app.logger.error(f"Error in get_entitlements: {str(e)}")
+        return jsonify({'message': f'Error retrieving entitlements: {str(e)}'}), 500
+
+@bp.route('/entitlements/batch', methods=['POST'])
+@admin_required
+def get_entitlements_batch():
+    """Entitlements for `user_ids` in the JSON body (max 1000 per call)."""
+    try:
+        data = request.get_json()
+        try:
+            user_ids = [int(user_id) for user_id in data['user_ids']]
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'message': 'user_ids must be a list of integers'}), 400
+        if len(user_ids) > 1000:
+            return jsonify({'message': 'At most 1000 user_ids per request'}), 400
+
+        entitlements = load_entitlements(user_ids)
+        feature = data.get('feature')
+        return jsonify([
+            serialize_entitlements(user_id, *entitlements[user_id], feature)
+            for user_id in user_ids
+        ]), 200
+    except Exception as e:
+        current_app.logger.error(f"Error in get_entitlements_batch: {str(e)}")
+        return jsonify({'message': f'Error retrieving entitlements: {str(e)}'}), 500
+
+def entitlement_metrics():
+    return [
+        '# HELP entitlement_cache_hits_total Entitlement cache hits.',
+        '# TYPE entitlement_cache_hits_total counter',
+        f'entitlement_cache_hits_total {entitlement_cache.hits}',
+        '# HELP entitlement_cache_misses_total Entitlement cache misses.',
+        '# TYPE entitlement_cache_misses_total counter',
+        f'entitlement_cache_misses_total {entitlement_cache.misses}',
+        '# HELP entitlement_cache_entries Entitlement cache size.',
+        '# TYPE entitlement_cache_entries gauge',
+        f'entitlement_cache_entries {len(entitlement_cache)}'
+    ]
+
+metrics_collectors.append(entitlement_metrics)
+
+# Analytics
+def dialect_insert(model):
+    """INSERT construct of the engine's dialect, which supports ON CONFLICT."""
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+def increment_stats(model, key, **deltas):
+    """Upsert a stats row, adding `deltas` to its counters."""
+    statement = dialect_insert(model).values(**key, **deltas)
+    statement = statement.on_conflict_do_update(
+        index_elements=list(key),
+        set_={name: getattr(model, name) + statement.excluded[name] for name in deltas}
+    )
+    db.session.execute(statement)
+
+def track_subscriptions_created(plan_id, price, count=1):
+    increment_stats(PlanStats, {'plan_id': plan_id}, active_subscriptions=count)
+    increment_stats(DailyStats, {'day': datetime.utcnow().date(), 'plan_id': plan_id},
+                    new_subscriptions=count, revenue=price * count)
+
+def track_subscriptions_renewed(plan_id, price, count=1):
+    increment_stats(DailyStats, {'day': datetime.utcnow().date(), 'plan_id': plan_id},
+                    renewals=count, revenue=price * count)
+
+def track_subscriptions_deactivated(plan_id, count=1, cancelled=False):
+    increment_stats(PlanStats, {'plan_id': plan_id}, active_subscriptions=-count)
+    if cancelled:
+        increment_stats(DailyStats, {'day': datetime.utcnow().date(), 'plan_id': plan_id},
+                        cancelled_subscriptions=count)
+
+def rebuild_analytics():
+    """Recompute the aggregate tables from the subscription table.
+
+    Renewals leave no rows of their own, so their counts are carried over
+    and their revenue recomputed at the current plan prices.
+    """
+    # date() so the keys match the other queries' day values on every dialect
+    renewals = Counter({(day, plan_id): count for day, plan_id, count in db.session.execute(
+        db.select(db.func.date(DailyStats.day), DailyStats.plan_id, DailyStats.renewals)
+        .where(DailyStats.renewals > 0)
+    )})
+    prices = {plan_id: price for plan_id, price in db.session.execute(db.select(Plan.id, Plan.price))}
+    DailyStats.query.delete()
+    PlanStats.query.delete()
+
+    db.session.execute(db.insert(PlanStats).from_select(
+        ['plan_id', 'active_subscriptions'],
+        db.select(Subscription.plan_id, db.func.count())
+        .where(Subscription.is_active == True)
+        .group_by(Subscription.plan_id)
+    ))
+
+    daily = Counter()
+    revenue = Counter()
+    created = db.session.execute(
+        db.select(db.func.date(Subscription.created_at), Subscription.plan_id,
+                  db.func.count(), db.func.sum(Plan.price))
+        .join(Plan, Subscription.plan_id == Plan.id)
+        .group_by(db.func.date(Subscription.created_at), Subscription.plan_id)
+    )
+    for day, plan_id, count, total in created:
+        daily[(day, plan_id, 'new')] += count
+        revenue[(day, plan_id)] += total or 0.0
+    cancelled = db.session.execute(
+        db.select(db.func.date(Subscription.cancelled_at), Subscription.plan_id, db.func.count())
+        .where(Subscription.cancelled_at != None)
+        .group_by(db.func.date(Subscription.cancelled_at), Subscription.plan_id)
+    )
+    for day, plan_id, count in cancelled:
+        daily[(day, plan_id, 'cancelled')] += count
+    for (day, plan_id), count in renewals.items():
+        daily[(day, plan_id, 'renewed')] += count
+        revenue[(day, plan_id)] += count * prices.get(plan_id, 0.0)
+
+    keys = {(day, plan_id) for day, plan_id, _ in daily}
+    rows = [{
+        'day': day if isinstance(day, date) else date.fromisoformat(day),
+        'plan_id': plan_id,
+        'new_subscriptions': daily[(day, plan_id, 'new')],
+        'cancelled_subscriptions': daily[(day, plan_id, 'cancelled')],
+        'renewals': daily[(day, plan_id, 'renewed')],
+        'revenue': revenue[(day, plan_id)]
+    } for day, plan_id in keys]
+    if rows:
+        db.session.execute(db.insert(DailyStats), rows)
+    db.session.commit()
+    return len(rows)
+
+@bp.cli.command('rebuild-analytics')
+def rebuild_analytics_command():
+    """Backfill the analytics aggregate tables."""
+    click.echo(f'Rebuilt {rebuild_analytics()} daily stats rows')
+
+@bp.route('/analytics/summary', methods=['GET'])
+@admin_required
+def get_analytics_summary():
+    """Active subscriptions and MRR per plan, plus daily new/cancelled/renewals/revenue.
+
+    Optional `from` and `to` dates (YYYY-MM-DD) bound the daily series,
+    which defaults to the last 30 days. Active counts drop when a
+    subscription is cancelled or swept as expired, so they lag natural
+    expiry by up to EXPIRY_SWEEP_INTERVAL.
+    """
+    try:
+        try:
+            end_day = date.fromisoformat(request.args['to']) if request.args.get('to') else datetime.utcnow().date()
+            start_day = (date.fromisoformat(request.args['from']) if request.args.get('from')
+                         else end_day - timedelta(days=29))
+        except ValueError as e:
+            return jsonify({'message': f'Invalid query parameter: {str(e)}'}), 400
+
+        plans = db.session.execute(
+            db.select(Plan.id, Plan.name, Plan.price, Plan.duration_days, PlanStats.active_subscriptions)
+            .outerjoin(PlanStats, PlanStats.plan_id == Plan.id)
+            .order_by(Plan.id)
+        ).all()
+        by_plan = [{
+            'plan_id': plan.id,
+            'plan_name': plan.name,
+            'active_subscriptions': plan.active_subscriptions or 0,
+            'mrr': round((plan.active_subscriptions or 0) * plan.price * 30 / plan.duration_days, 2)
+                   if plan.duration_days else 0.0
+        } for plan in plans]
+
+        days = db.session.execute(
+            db.select(DailyStats.day,
+                      db.func.sum(DailyStats.new_subscriptions),
+                      db.func.sum(DailyStats.cancelled_subscriptions),
+                      db.func.sum(DailyStats.renewals),
+                      db.func.sum(DailyStats.revenue))
+            .where(DailyStats.day >= start_day, DailyStats.day <= end_day)
+            .group_by(DailyStats.day)
+            .order_by(DailyStats.day)
+        ).all()
+
+        return jsonify({
+            'active_subscriptions': sum(plan['active_subscriptions'] for plan in by_plan),
+            'mrr': round(sum(plan['mrr'] for plan in by_plan), 2),
+            'plans': by_plan,
+            'daily': [{
+                'day': day.isoformat(),
+                'new_subscriptions': new,
+                'cancelled_subscriptions': cancelled,
+                'renewals': renewals,
+                'revenue': revenue
+            } for day, new, cancelled, renewals, revenue in days]
+        }), 200
+    except Exception as e:
+        current_app.logger.error(f"Error in get_analytics_summary: {str(e)}")
+        return jsonify({'message': f'Error retrieving analytics: {str(e)}'}), 500
+
+# Bulk import/export
+# Stored for imported users without a password; never matches any password
+UNUSABLE_PASSWORD = '!'
+
+def read_bulk_rows():
+    """Yield (row number, dict, error) from an NDJSON or CSV request body stream.
+
+    Lines that are not a JSON object come with row None and an error message.
+    """
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    if request.mimetype == 'text/csv':
+        for number, row in enumerate(csv.DictReader(stream), start=1):
+            yield number, row, None
+    else:
+        for number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield number, None, f'Invalid JSON: {str(e)}'
+                continue
+            if isinstance(row, dict):
+                yield number, row, None
+            else:
+                yield number, None, 'Row must be a JSON object'
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+def import_users_chunk(chunk):
+    """Validate and insert one chunk of user rows; returns per-row results."""
+    results = {}
+    usernames = {row.get('username') for _, row in chunk}
+    emails = {row.get('email') for _, row in chunk}
+    taken_usernames = set(db.session.execute(
+        db.select(User.username).where(User.username.in_(usernames))
+    ).scalars())
+    taken_emails = set(db.session.execute(
+        db.select(User.email).where(User.email.in_(emails))
+    ).scalars())
+
+    accepted = []
+    for number, row in chunk:
+        if not row.get('username') or not row.get('email'):
+            results[number] = {'row': number, 'status': 'error', 'message': 'username and email are required'}
+        elif row['username'] in taken_usernames:
+            results[number] = {'row': number, 'status': 'error', 'message': 'Username already exists'}
+        elif row['email'] in taken_emails:
+            results[number] = {'row': number, 'status': 'error', 'message': 'Email already exists'}
+        else:
+            taken_usernames.add(row['username'])
+            taken_emails.add(row['email'])
+            accepted.append((number, row))
+
+    to_hash = [row['password'] for _, row in accepted if row.get('password')]
+    hashes = iter(password_hasher.hash_many(to_hash))
+    now = datetime.utcnow()
+    values = [{
+        'username': row['username'],
+        'email': row['email'],
+        'role': row.get('role') or 'user',
+        'password_hash': next(hashes) if row.get('password') else UNUSABLE_PASSWORD,
+        'created_at': now
+    } for _, row in accepted]
+
+    if values:
+        # Matched back by username: returning rows in parameter order would
+        # make SQLite insert one row per statement
+        ids = dict(db.session.execute(
+            db.insert(User).returning(User.username, User.id), values
+        ).all())
+        db.session.commit()
+        for number, row in accepted:
+            results[number] = {'row': number, 'status': 'created', 'id': ids[row['username']]}
+    return [results[number] for number, _ in chunk]
+
+def import_subscriptions_chunk(chunk):
+    """Validate and insert one chunk of subscription rows; returns per-row results."""
+    results = {}
+    now = datetime.utcnow()
+    parsed = []
+    for number, row in chunk:
+        try:
+            parsed.append((number, int(row['user_id']), int(row['plan_id']),
+                           parse_datetime_arg(row.get('end_date'))))
+        except (KeyError, TypeError, ValueError) as e:
+            results[number] = {'row': number, 'status': 'error', 'message': f'Invalid row: {str(e)}'}
+
+    user_ids = {user_id for _, user_id, _, _ in parsed}
+    plan_ids = {plan_id for _, _, plan_id, _ in parsed}
+    known_users = set(db.session.execute(
+        db.select(User.id).where(User.id.in_(user_ids), User.is_deleted == False)
+    ).scalars())
+    plans = {plan_id: (duration_days, price) for plan_id, duration_days, price in db.session.execute(
+        db.select(Plan.id, Plan.duration_days, Plan.price).where(Plan.id.in_(plan_ids))
+    )}
+    # Retire expired rows not yet swept; they would trip the unique index
+    expired_users = {row.user_id for row in deactivate_expired_subscriptions(
+        Subscription.user_id.in_(user_ids), now=now
+    )}
+    active_pairs = set(db.session.execute(
+        db.select(Subscription.user_id, Subscription.plan_id).where(
+            Subscription.user_id.in_(user_ids),
+            Subscription.is_active == True
+        )
+    ).tuples())
+
+    accepted = []
+    values = []
+    for number, user_id, plan_id, end_date in parsed:
+        if user_id not in known_users:
+            results[number] = {'row': number, 'status': 'error', 'message': 'User not found'}
+        elif plan_id not in plans:
+            results[number] = {'row': number, 'status': 'error', 'message': 'Plan not found'}
+        elif end_date is not None and end_date <= now:
+            results[number] = {'row': number, 'status': 'error', 'message': 'end_date must be in the future'}
+        elif (user_id, plan_id) in active_pairs:
+            results[number] = {'row': number, 'status': 'error',
+                               'message': 'User already has an active subscription to this plan'}
+        else:
+            active_pairs.add((user_id, plan_id))
+            accepted.append(number)
+            values.append({
+                'user_id': user_id,
+                'plan_id': plan_id,
+                'start_date': now,
+                'end_date': end_date or now + timedelta(days=plans[plan_id][0]),
+                'is_active': True,
+                'created_at': now
+            })
+
+    if values:
+        # Matched back by (user_id, plan_id), unique among the accepted rows:
+        # returning rows in parameter order would make SQLite insert one row
+        # per statement. Table-level, like record_changes.
+        created = {(user_id, plan_id): subscription_id for subscription_id, user_id, plan_id in db.session.execute(
+            db.insert(Subscription.__table__)
+            .returning(Subscription.id, Subscription.user_id, Subscription.plan_id), values
+        )}
+        ids = [created[(value['user_id'], value['plan_id'])] for value in values]
+        created_by_plan = Counter(value['plan_id'] for value in values)
+        for plan_id, count in created_by_plan.items():
+            track_subscriptions_created(plan_id, plans[plan_id][1], count)
+        for number, subscription_id in zip(accepted, ids):
+            results[number] = {'row': number, 'status': 'created', 'id': subscription_id}
+        record_changes('subscription', 'created', [
+            (subscription_id, subscription_change(value, id=subscription_id))
+            for value, subscription_id in zip(values, ids)
+        ])
+    db.session.commit()
+    change_notifier.notify()
+    changed_users = {value['user_id'] for value in values}
+    invalidate_subscriptions(*expired_users, *changed_users)
+    return [results[number] for number, _ in chunk]
+
+def bulk_import(import_chunk, name):
+    """Import the request body chunk by chunk and report every row.
+
+    Each chunk commits on its own, so if the body turns out to be unreadable
+    or a chunk fails, the response still lists the rows already imported,
+    next to an error message.
+    """
+    results = []
+    message, status = None, 200
+    try:
+        for chunk in chunked(read_bulk_rows(), current_app.config['BULK_CHUNK_SIZE']):
+            rows = [(number, row) for number, row, error in chunk if error is None]
+            imported = {result['row']: result for result in import_chunk(rows)} if rows else {}
+            results.extend(imported.get(number) or {'row': number, 'status': 'error', 'message': error}
+                           for number, _, error in chunk)
+    except (ValueError, csv.Error) as e:
+        db.session.rollback()
+        message, status = f'Invalid import data: {str(e)}', 400
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error in {name}: {str(e)}")
+        message, status = f'Error importing rows: {str(e)}', 500
+
+    created = sum(1 for result in results if result['status'] == 'created')
+    body = {
+        'created': created,
+        'failed': len(results) - created,
+        'results': results
+    }
+    if message:
+        body['message'] = message
+    return jsonify(body), status
+
+@bp.route('/users/bulk', methods=['POST'])
+@admin_required
+def bulk_create_users():
+    """Import users from an NDJSON or CSV (Content-Type: text/csv) body.
+
+    Rows need username and email; password and role are optional. Users
+    imported without a password cannot log in until one is set.
+    """
+    return bulk_import(import_users_chunk, 'bulk_create_users')
+
+@bp.route('/subscriptions/bulk', methods=['POST'])
+@admin_required
+def bulk_create_subscriptions():
+    """Import subscriptions from an NDJSON or CSV (Content-Type: text/csv) body.
+
+    Rows need user_id and plan_id; end_date defaults to the plan duration.
+    """
+    return bulk_import(import_subscriptions_chunk, 'bulk_create_subscriptions')
+
+def stream_export(query, fmt):
+    """Yield query rows as CSV or NDJSON from a server-side cursor."""
+    query = query.execution_options(stream_results=True, yield_per=SUBSCRIPTIONS_STREAM_BATCH)
+    result = db.session.execute(query)
+    fields = list(result.keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(fields)
+    try:
+        for row in result:
+            values = [value.isoformat() if isinstance(value, datetime) else value for value in row]
+            if fmt == 'csv':
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(fields, values))) + '\n')
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    except Exception as e:
+        current_app.logger.error(f"Error in stream_export: {str(e)}")
+
+def export_response(query):
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'message': 'format must be csv or ndjson'}), 400
+    return Response(
+        stream_with_context(stream_export(query, fmt)),
+        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    )
+
+@bp.route('/users/export', methods=['GET'])
+@admin_required
+def export_users():
+    return export_response(db.select(
+        User.id, User.username, User.email, User.role, User.created_at
+    ).where(User.is_deleted == False).order_by(User.id))
+
+@bp.route('/subscriptions/export', methods=['GET'])
+@admin_required
+def export_subscriptions():
+    try:
+        filters = subscription_filters(request.args)
+    except ValueError as e:
+        return jsonify({'message': f'Invalid query parameter: {str(e)}'}), 400
+    return export_response(db.select(
+        Subscription.id, Subscription.user_id, Subscription.plan_id,
+        Subscription.start_date, Subscription.end_date, Subscription.is_active
+    ).where(*filters).order_by(Subscription.id))
+
+def deactivate_duplicate_subscriptions():
+    """Keep only the newest active subscription per user and plan.
+
+    Older databases could hold several; they must be resolved before the
+    partial unique index can be created.
+    """
+    duplicates = db.session.execute(
+        db.select(Subscription.user_id, Subscription.plan_id, db.func.max(Subscription.id))
+        .where(Subscription.is_active == True)
+        .group_by(Subscription.user_id, Subscription.plan_id)
+        .having(db.func.count() > 1)
+    ).all()
+    for user_id, plan_id, newest_id in duplicates:
+        result = db.session.execute(
+            db.update(Subscription)
+            .where(Subscription.user_id == user_id, Subscription.plan_id == plan_id,
+                   Subscription.is_active == True, Subscription.id != newest_id)
+            .values(is_active=False)
+        )
+        track_subscriptions_deactivated(plan_id, result.rowcount)
+    db.session.commit()
+    if duplicates:
+        current_app.logger.info(f"Deactivated duplicate active subscriptions for {len(duplicates)} user/plan pairs")
+
+def migrate_schema():
+    """Add model columns and indexes missing from an existing database.
+
+    `db.create_all()` only creates columns and indexes together with new
+    tables, so databases created before one was added need this step.
+    """
+    inspector = db.inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                    conn.execute(db.text(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}'))
+    subscription_indexes = {index['name'] for index in inspector.get_indexes(Subscription.__tablename__)}
+    if 'uq_subscription_user_plan_active' not in subscription_indexes:
+        deactivate_duplicate_subscriptions()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+# Subscription expiry
+def deactivate_expired_subscriptions(*criteria, limit=None, now=None):
+    """Mark active subscriptions past their end_date (and matching `criteria`) inactive.
+
+    Keeps the analytics counters in step, records 'expired' changes and
+    returns the affected (id, user_id, plan_id, ...) rows. The caller
+    commits, notifies change readers and invalidates entitlements.
+    """
+    query = (
+        db.select(Subscription.id, Subscription.user_id, Subscription.plan_id,
+                  Subscription.start_date, Subscription.end_date, Subscription.cancelled_at)
+        .where(Subscription.is_active == True, Subscription.end_date < (now or datetime.utcnow()), *criteria)
+        .limit(limit)
+    )
+    rows = db.session.execute(query).all()
+    if rows:
+        # Only rows still active when updated: another worker's sweeper may
+        # have retired some since the SELECT
+        changed = set(db.session.execute(
+            db.update(Subscription)
+            .where(Subscription.id.in_([row.id for row in rows]), Subscription.is_active == True)
+            .values(is_active=False)
+            .returning(Subscription.id)
+        ).scalars())
+        rows = [row for row in rows if row.id in changed]
+        for plan_id, count in Counter(row.plan_id for row in rows).items():
+            track_subscriptions_deactivated(plan_id, count)
+        record_changes('subscription', 'expired', [
+            (row.id, subscription_change(row, is_active=False)) for row in rows
+        ])
+    return rows
+
+def expire_subscriptions(batch_size=None, now=None):
+    """Mark active subscriptions past their end_date as inactive.
+
+    Works in bounded batches, each a range search on
+    ix_subscription_active_end_date followed by a short write transaction,
+    so the write lock is never held for long. Returns run metrics.
+    """
+    batch_size = batch_size or current_app.config['EXPIRY_SWEEP_BATCH_SIZE']
+    now = now or datetime.utcnow()
+    started = time.perf_counter()
+    expired = batches = 0
+
+    while True:
+        rows = deactivate_expired_subscriptions(limit=batch_size, now=now)
+        if not rows:
+            break
+        db.session.commit()
+        change_notifier.notify()
+        invalidate_subscriptions(*{row.user_id for row in rows})
+        expired += len(rows)
+        batches += 1
+
+    seconds = time.perf_counter() - started
+    stats = {
+        'expired': expired,
+        'batches': batches,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(expired / seconds, 1) if seconds else 0.0
+    }
+    current_app.logger.info(f"Expired {expired} subscriptions in {batches} batches "
+                    f"({stats['rows_per_second']} rows/s)")
+    return stats
+
+def run_expiry_sweeper(app, interval):
+    # First sweep after one interval, so booting and `flask init-db` stay
+    # clear of the database
+    while True:
+        time.sleep(interval)
+        with app.app_context():
+            try:
+                expire_subscriptions()
+                purge_idempotency_keys()
+                compact_changes()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Error in expiry sweeper: {str(e)}")
+
+def start_expiry_sweeper(app):
+    interval = app.config['EXPIRY_SWEEP_INTERVAL']
+    if interval > 0:
+        threading.Thread(
+            target=run_expiry_sweeper, args=(app, interval),
+            name='expiry-sweeper', daemon=True
+        ).start()
+
+@bp.cli.command('expire-subscriptions')
+@click.option('--batch-size', type=int, default=None, help='Rows updated per transaction.')
+def expire_subscriptions_command(batch_size):
+    """Deactivate expired subscriptions and report throughput."""
+    stats = expire_subscriptions(batch_size)
+    click.echo(json.dumps(stats))
+
+# Deleted user purge
+def purge_deleted_users(chunk_size=None):
+    """Delete soft-deleted users and their subscriptions; returns users purged.
+
+    Subscriptions go in chunks of `chunk_size`, each its own short write
+    transaction, so a large account never holds the write lock for long.
+    """
+    chunk_size = chunk_size or current_app.config['USER_PURGE_CHUNK_SIZE']
+    purged = 0
+    while True:
+        user_id = db.session.execute(
+            db.select(User.id).where(User.is_deleted == True).limit(1)
+        ).scalar()
+        if user_id is None:
+            return purged
+        while True:
+            ids = db.session.execute(
+                db.select(Subscription.id).where(Subscription.user_id == user_id).limit(chunk_size)
+            ).scalars().all()
+            if not ids:
+                break
+            db.session.execute(db.delete(Subscription).where(Subscription.id.in_(ids)))
+            db.session.commit()
+            time.sleep(current_app.config['USER_PURGE_PAUSE'])
+        db.session.execute(db.delete(User).where(User.id == user_id, User.is_deleted == True))
+        db.session.commit()
+        purged += 1
+
+class UserPurgeWorker:
+    """Background thread that runs purge_deleted_users whenever woken."""
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def wake(self):
+        """Start or wake the worker for the current app."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, args=(current_app._get_current_object(),),
+                    name='user-purge', daemon=True
+                )
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self, app):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with app.app_context():
+                try:
+                    purged = purge_deleted_users()
+                    app.logger.info(f"Purged {purged} deleted users")
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f"Error in user purge: {str(e)}")
+
+user_purger = UserPurgeWorker()
+
+@bp.before_app_request
+def resume_user_purge():
+    # Finish purges interrupted by a restart, once per process
+    if not user_purger.started:
+        user_purger.wake()
+
+@bp.cli.command('purge-deleted-users')
+@click.option('--chunk-size', type=int, default=None, help='Subscription rows deleted per transaction.')
+def purge_deleted_users_command(chunk_size):
+    """Delete soft-deleted users and their subscriptions now."""
+    click.echo(json.dumps({'purged': purge_deleted_users(chunk_size)}))
+
+# Subscription renewal
+# User-id partitions created per worker, so a slow range does not idle the pool
+RENEWAL_PARTITIONS_PER_WORKER = 4
+# JobLease held while a run is open or processed, by whichever process
+# started it; a crashed holder blocks new runs for at most
+# RENEWAL_LEASE_SECONDS after its last batch
+RENEWAL_LEASE = 'renewals'
+RENEWAL_LEASE_SECONDS = 300
+
+class RenewalInProgress(Exception):
+    pass
+
+def acquire_lease(name, seconds):
+    """Claim the JobLease `name` for `seconds`; returns a holder token, or None if held."""
+    now = datetime.utcnow()
+    holder = secrets.token_hex(16)
+    claimed = db.session.execute(
+        db.update(JobLease)
+        .where(JobLease.name == name, JobLease.expires_at < now)
+        .values(holder=holder, expires_at=now + timedelta(seconds=seconds))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        claimed = db.session.execute(dialect_insert(JobLease).values(
+            name=name, holder=holder, expires_at=now + timedelta(seconds=seconds)
+        ).on_conflict_do_nothing(index_elements=['name'])).rowcount
+    db.session.commit()
+    return holder if claimed else None
+
+def extend_lease(name, holder, seconds):
+    """Push back the expiry of a lease held by `holder` within the current transaction.
+
+    Returns False if the lease expired and was taken over.
+    """
+    return db.session.execute(
+        db.update(JobLease)
+        .where(JobLease.name == name, JobLease.holder == holder)
+        .values(expires_at=datetime.utcnow() + timedelta(seconds=seconds))
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+def release_lease(name, holder):
+    db.session.execute(db.delete(JobLease).where(JobLease.name == name, JobLease.holder == holder))
+    db.session.commit()
+
+def shift_days(column, days):
+    """SQL expression for a DateTime `column` moved `days` days later."""
+    if db.engine.dialect.name == 'postgresql':
+        return column + timedelta(days=days)
+    # SQLite stores 'YYYY-MM-DD HH:MM:SS.ffffff'; datetime() drops the fraction
+    return db.func.datetime(column, f'+{days} days').op('||')(db.func.substr(column, 20))
+
+def create_renewal_run(window_start, window_end, partitions):
+    """Record a run and split the user_id range of its candidates into partitions."""
+    low, high = db.session.execute(
+        db.select(db.func.min(Subscription.user_id), db.func.max(Subscription.user_id))
+        .where(Subscription.is_active == True,
+               Subscription.end_date >= window_start,
+               Subscription.end_date < window_end)
+    ).one()
+    run = RenewalRun(window_start=window_start, window_end=window_end)
+    db.session.add(run)
+    db.session.flush()
+    if low is not None:
+        step = -(-(high - low + 1) // partitions)
+        db.session.add_all(
+            RenewalPartition(run_id=run.id, low_user_id=start, high_user_id=min(start + step, high + 1))
+            for start in range(low, high + 1, step)
+        )
+    db.session.commit()
+    return run
+
+# App of a renewal pool worker process, built by init_renewal_worker
+renewal_worker_app = None
+
+def init_renewal_worker(config):
+    global renewal_worker_app
+    renewal_worker_app = create_app(config)
+
+def renew_partition_in_worker(run_id, low_user_id, batch_size, holder):
+    with renewal_worker_app.app_context():
+        return renew_partition(run_id, low_user_id, batch_size, holder)
+
+def renew_partition(run_id, low_user_id, batch_size, holder=None):
+    """Renew the subscriptions of one partition of a run; returns renewals made.
+
+    Candidates come from a range search on ix_subscription_active_end_date
+    and are taken in id order. Each batch's transaction first moves the
+    partition checkpoint from the id it started at, and stops if another
+    process got there first, so no batch is renewed twice. The UPDATE
+    (one per plan duration) re-checks is_active and the window, so a row
+    cancelled or renewed since it was read is skipped; only rows it changed
+    are counted and recorded as 'renewed' changes. The run's lease, when
+    `holder` is given, is extended in the same transaction.
+    Subscriptions to inactive plans are not renewed.
+    """
+    run = db.session.get(RenewalRun, run_id)
+    partition = db.session.get(RenewalPartition, (run_id, low_user_id))
+    window_start, window_end = run.window_start, run.window_end
+    high_user_id = partition.high_user_id
+    last_subscription_id, completed = partition.last_subscription_id, partition.completed
+    renewed = 0
+    while not completed:
+        rows = db.session.execute(
+            db.select(Subscription.id, Subscription.user_id, Subscription.plan_id,
+                      Subscription.start_date, Subscription.end_date, Subscription.cancelled_at,
+                      Plan.duration_days, Plan.price)
+            .join(Plan, Subscription.plan_id == Plan.id)
+            .where(Subscription.is_active == True,
+                   Subscription.end_date >= window_start,
+                   Subscription.end_date < window_end,
+                   Subscription.user_id >= low_user_id,
+                   Subscription.user_id < high_user_id,
+                   Subscription.id > last_subscription_id,
+                   Plan.is_active == True)
+            .order_by(Subscription.id)
+            .limit(batch_size)
+        ).all()
+        completed = len(rows) < batch_size
+        next_subscription_id = rows[-1].id if rows else last_subscription_id
+        claimed = db.session.execute(
+            db.update(RenewalPartition)
+            .where(RenewalPartition.run_id == run_id,
+                   RenewalPartition.low_user_id == low_user_id,
+                   RenewalPartition.last_subscription_id == last_subscription_id,
+                   RenewalPartition.completed == False)
+            .values(last_subscription_id=next_subscription_id, completed=completed)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not claimed or (holder and not extend_lease(RENEWAL_LEASE, holder, RENEWAL_LEASE_SECONDS)):
+            db.session.rollback()
+            break
+
+        by_duration = {}
+        for row in rows:
+            by_duration.setdefault(row.duration_days, []).append(row.id)
+        changed = set()
+        for days, ids in by_duration.items():
+            changed.update(db.session.execute(
+                db.update(Subscription)
+                .where(Subscription.id.in_(ids),
+                       Subscription.is_active == True,
+                       Subscription.end_date >= window_start,
+                       Subscription.end_date < window_end)
+                .values(end_date=shift_days(Subscription.end_date, days))
+                .returning(Subscription.id)
+                .execution_options(synchronize_session=False)
+            ).scalars())
+        rows = [row for row in rows if row.id in changed]
+        for (plan_id, price), count in Counter((row.plan_id, row.price) for row in rows).items():
+            track_subscriptions_renewed(plan_id, price, count)
+        record_changes('subscription', 'renewed', [
+            (row.id, subscription_change(row, is_active=True,
+                                         end_date=row.end_date + timedelta(days=row.duration_days)))
+            for row in rows
+        ])
+        if rows:
+            db.session.execute(
+                db.update(RenewalPartition)
+                .where(RenewalPartition.run_id == run_id, RenewalPartition.low_user_id == low_user_id)
+                .values(renewed=RenewalPartition.renewed + len(rows))
+                .execution_options(synchronize_session=False)
+            )
+        db.session.commit()
+        change_notifier.notify()
+        invalidate_subscriptions(*(row.user_id for row in rows))
+        last_subscription_id = next_subscription_id
+        renewed += len(rows)
+    return renewed
+
+def open_renewal_run(window_hours=None, workers=None, now=None, resume=True):
+    """Return (run, resumed): the latest unfinished run when `resume` is set, else a new one."""
+    if resume:
+        run = db.session.execute(
+            db.select(RenewalRun).where(RenewalRun.finished_at == None).order_by(RenewalRun.id.desc())
+        ).scalars().first()
+        if run is not None:
+            return run, True
+    window_hours = window_hours or current_app.config['RENEWAL_WINDOW_HOURS']
+    workers = current_app.config['RENEWAL_WORKERS'] if workers is None else workers
+    now = now or datetime.utcnow()
+    run = create_renewal_run(now, now + timedelta(hours=window_hours),
+                             max(workers, 1) * RENEWAL_PARTITIONS_PER_WORKER)
+    return run, False
+
+def process_renewal_run(run_id, workers=None, batch_size=None, holder=None):
+    """Renew the unfinished partitions of a run and mark it finished.
+
+    Partitions are spread over a process pool of `workers` (0 renews
+    inline). `holder` is the caller's RENEWAL_LEASE, which the batches keep
+    extending; they stop if it is lost. Returns run metrics.
+    """
+    workers = current_app.config['RENEWAL_WORKERS'] if workers is None else workers
+    batch_size = batch_size or current_app.config['RENEWAL_BATCH_SIZE']
+    started = time.perf_counter()
+    pending = db.session.execute(
+        db.select(RenewalPartition.low_user_id)
+        .where(RenewalPartition.run_id == run_id, RenewalPartition.completed == False)
+        .order_by(RenewalPartition.low_user_id)
+    ).scalars().all()
+    # Workers open their own connections; release this one meanwhile
+    db.session.commit()
+
+    if workers and len(pending) > 1:
+        # Each worker builds its own app (and engine) from this app's settings
+        config = dict(current_app.config, EXPIRY_SWEEP_INTERVAL=0)
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending)),
+                                 initializer=init_renewal_worker, initargs=(config,)) as pool:
+            renewed = sum(pool.map(renew_partition_in_worker, repeat(run_id), pending,
+                                   repeat(batch_size), repeat(holder)))
+        # The workers' commits bump the table versions and wake change
+        # readers in their own processes
+        note_written_tables(db.session, ['subscription'])
+        change_notifier.notify()
+    else:
+        renewed = sum(renew_partition(run_id, low_user_id, batch_size, holder) for low_user_id in pending)
+
+    db.session.expire_all()
+    run = db.session.get(RenewalRun, run_id)
+    run.renewed, unfinished = db.session.execute(
+        db.select(db.func.coalesce(db.func.sum(RenewalPartition.renewed), 0),
+                  db.func.count().filter(RenewalPartition.completed == False))
+        .where(RenewalPartition.run_id == run_id)
+    ).one()
+    # A partition left unfinished lost the lease; the run stays open to resume
+    if not unfinished:
+        run.finished_at = datetime.utcnow()
+    db.session.commit()
+
+    seconds = time.perf_counter() - started
+    stats = {
+        'run_id': run_id,
+        'window_start': run.window_start.isoformat(),
+        'window_end': run.window_end.isoformat(),
+        'partitions': len(pending),
+        'renewed': renewed,
+        'total_renewed': run.renewed,
+        'seconds': round(seconds, 3),
+        'renewals_per_second': round(renewed / seconds, 1) if seconds else 0.0
+    }
+    current_app.logger.info(f"Renewed {renewed} subscriptions in run {run_id} "
+                    f"({stats['renewals_per_second']} renewals/s)")
+    return stats
+
+def renew_subscriptions(window_hours=None, workers=None, batch_size=None, now=None, resume=True):
+    """Renew active subscriptions ending within the next `window_hours`.
+
+    Continues the latest unfinished run when `resume` is set, otherwise
+    starts a new one. Returns run metrics; raises RenewalInProgress while
+    another process holds RENEWAL_LEASE.
+    """
+    holder = acquire_lease(RENEWAL_LEASE, RENEWAL_LEASE_SECONDS)
+    if holder is None:
+        raise RenewalInProgress('A renewal run is already in progress')
+    try:
+        run, resumed = open_renewal_run(window_hours, workers, now, resume)
+        return dict(process_renewal_run(run.id, workers, batch_size, holder), resumed=resumed)
+    finally:
+        release_lease(RENEWAL_LEASE, holder)
+
+@bp.cli.command('renew-subscriptions')
+@click.option('--window-hours', type=float, default=None, help='Renew subscriptions ending within this many hours.')
+@click.option('--workers', type=int, default=None, help='Worker processes; 0 renews inline.')
+@click.option('--batch-size', type=int, default=None, help='Subscriptions renewed per transaction.')
+@click.option('--new-run', is_flag=True, help='Start a new run instead of resuming an unfinished one.')
+def renew_subscriptions_command(window_hours, workers, batch_size, new_run):
+    """Renew expiring subscriptions and report throughput."""
+    try:
+        stats = renew_subscriptions(window_hours, workers, batch_size, resume=not new_run)
+    except RenewalInProgress as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(stats))
+
+def run_renewals_in_background(app, run_id, workers, holder):
+    with app.app_context():
+        try:
+            process_renewal_run(run_id, workers, holder=holder)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error in renewal run: {str(e)}")
+        finally:
+            release_lease(RENEWAL_LEASE, holder)
+
+@bp.route('/subscriptions/renewals', methods=['POST'])
+@admin_required
+def start_renewals():
+    """Start (or resume) a renewal run in the background.
+
+    Optional JSON `window_hours` and `workers` override the configured
+    defaults; an unfinished run is resumed with its original window.
+    Progress is reported by GET /subscriptions/renewals/<id>.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            window_hours = float(data['window_hours']) if data.get('window_hours') is not None else None
+            workers = int(data['workers']) if data.get('workers') is not None else None
+        except (TypeError, ValueError) as e:
+            return jsonify({'message': f'Invalid parameter: {str(e)}'}), 400
+        if (window_hours is not None and window_hours <= 0) or (workers is not None and workers < 0):
+            return jsonify({'message': 'window_hours must be positive and workers non-negative'}), 400
+
+        holder = acquire_lease(RENEWAL_LEASE, RENEWAL_LEASE_SECONDS)
+        if holder is None:
+            return jsonify({'message': 'A renewal run is already in progress'}), 409
+        try:
+            run, resumed = open_renewal_run(window_hours, workers)
+            threading.Thread(
+                target=run_renewals_in_background,
+                args=(current_app._get_current_object(), run.id, workers, holder),
+                name='renewals', daemon=True
+            ).start()
+        except Exception:
+            db.session.rollback()
+            release_lease(RENEWAL_LEASE, holder)
+            raise
+        return jsonify({
+            'id': run.id,
+            'resumed': resumed,
+            'window_start': run.window_start.isoformat(),
+            'window_end': run.window_end.isoformat()
+        }), 202
+    except Exception as e:
+        current_app.logger.error(f"Error in start_renewals: {str(e)}")
+        return jsonify({'message': f'Error starting renewals: {str(e)}'}), 500
+
+@bp.route('/subscriptions/renewals/<int:id>', methods=['GET'])
+@admin_required
+def get_renewal_run(id):
+    try:
+        run = db.session.get(RenewalRun, id)
+        if run is None:
+            return jsonify({'message': 'Renewal run not found'}), 404
+        partitions = RenewalPartition.query.filter_by(run_id=id).all()
+        return jsonify({
+            'id': run.id,
+            'window_start': run.window_start.isoformat(),
+            'window_end': run.window_end.isoformat(),
+            'started_at': run.started_at.isoformat(),
+            'finished_at': run.finished_at.isoformat() if run.finished_at else None,
+            'renewed': sum(partition.renewed for partition in partitions),
+            'partitions': len(partitions),
+            'completed_partitions': sum(1 for partition in partitions if partition.completed)
+        }), 200
+    except Exception as e:
+        current_app.logger.error(f"Error in get_renewal_run: {str(e)}")
+        return jsonify({'message': f'Error retrieving renewal run: {str(e)}'}), 500
+
 # Initialize the database
-with app.app_context():
+def init_db():
+    """Create or migrate the schema and bootstrap the admin user.
+
+    Safe to run repeatedly and from several processes at once: the admin
+    insert is a no-op when the username already exists.
+    """
+    analytics_missing = not db.inspect(db.engine).has_table(PlanStats.__tablename__)
     db.create_all()
+    migrate_schema()
+    create_search_index()
+    if analytics_missing:
+        rebuild_analytics()
     
     # Create admin user if it doesn't exist
     if not User.query.filter_by(username='admin').first():
-        admin = User(
-            username='admin',
-            email='admin@example.com',
-            role='admin'
+        db.session.execute(
+            dialect_insert(User).values(
+                username='admin',
+                email='admin@example.com',
+                password_hash=password_hasher.hash('admin123'),
+                role='admin'
+            ).on_conflict_do_nothing()
         )
-        admin.set_password('admin123')
-        db.session.add(admin)
-        
         db.session.commit()
 
+@bp.cli.command('init-db')
+def init_db_command():
+    """Create the database schema and the admin user."""
+    init_db()
+    click.echo('Initialized the database')
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
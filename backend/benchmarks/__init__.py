@@ -0,0 +1,4 @@
+"""Benchmarks and load tests for the subscription backend.
+
+Run modules from the backend directory, e.g. ``python -m benchmarks.load``.
+"""
@@ -0,0 +1,106 @@
+"""Concurrent write benchmark for the database engine profiles.
+
+Runs threads that create and cancel subscriptions through the Flask test
+client against a fresh SQLite database, once per DB_PROFILE, and reports
+writes per second and the rate of 'database is locked' errors.
+
+    python -m benchmarks.concurrency --threads 16 --seconds 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PROFILES = ('default', 'production')
+
+
+def run_profile(threads, seconds):
+    from app import create_app, init_db
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+    client = app.test_client()
+    token = client.post('/login', json={'username': 'admin', 'password': 'admin123'}).json['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    plan_ids = [
+        client.post('/plans', headers=headers, json={
+            'name': f'bench plan {i}', 'price': 10, 'duration_days': 30
+        }).json['id']
+        for i in range(threads)
+    ]
+
+    counts = {'writes': 0, 'lock_errors': 0, 'other_errors': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def record(response):
+        with lock:
+            if response.status_code < 400:
+                counts['writes'] += 1
+            elif 'locked' in response.get_data(as_text=True):
+                counts['lock_errors'] += 1
+            else:
+                counts['other_errors'] += 1
+
+    def worker(plan_id):
+        thread_client = app.test_client()
+        while time.perf_counter() < deadline:
+            response = thread_client.post('/subscriptions', headers=headers, json={'plan_id': plan_id})
+            record(response)
+            if response.status_code == 201:
+                record(thread_client.delete(f"/subscriptions/{response.json['id']}", headers=headers))
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(plan_id,)) for plan_id in plan_ids]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    attempts = sum(counts.values())
+    return {
+        'profile': app.config['DB_PROFILE'],
+        'threads': threads,
+        'writes_per_second': round(counts['writes'] / elapsed, 1),
+        'lock_error_rate': round(counts['lock_errors'] / attempts, 4) if attempts else 0.0,
+        **counts
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--profile', choices=PROFILES,
+                        help='Run a single profile in this process (used internally).')
+    args = parser.parse_args()
+
+    if args.profile:
+        print(json.dumps(run_profile(args.threads, args.seconds)))
+        return
+
+    results = []
+    for profile in PROFILES:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ,
+                       DB_PROFILE=profile,
+                       DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                       PASSWORD_HASH_WORKERS='0')
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.concurrency', '--profile', profile,
+                 '--threads', str(args.threads), '--seconds', str(args.seconds)],
+                env=env, check=True, capture_output=True, text=True
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
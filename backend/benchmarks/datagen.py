@@ -0,0 +1,68 @@
+"""Deterministic synthetic data for benchmarks.
+
+Rows are written with the sqlite3 module straight into a database that
+already has the app's schema, so millions of rows load in seconds.
+"""
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+PASSWORD = 'password'
+
+
+def reference_time():
+    """Midnight today (UTC), so runs on the same day generate identical data."""
+    return datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def generate(path, users, plans, subscriptions, seed=42, first_user_id=1,
+             password_hash='!', now=None):
+    """Insert `users`, `plans` and `subscriptions` rows into the database at `path`.
+
+    User ids start at `first_user_id` and usernames are `user<id>`; every
+    user gets `password_hash`. Plan ids start after any existing plans.
+    Returns the generated user and plan id ranges.
+    """
+    rng = random.Random(seed)
+    now = now or reference_time()
+    created = now.isoformat(' ')
+    conn = sqlite3.connect(path)
+    first_plan_id = (conn.execute('SELECT MAX(id) FROM plan').fetchone()[0] or 0) + 1
+    user_ids = range(first_user_id, first_user_id + users)
+    plan_ids = range(first_plan_id, first_plan_id + plans)
+
+    conn.executemany(
+        'INSERT INTO user (id, username, email, password_hash, role, created_at) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        ((i, f'user{i}', f'user{i}@example.com', password_hash, 'user', created) for i in user_ids)
+    )
+    conn.executemany(
+        'INSERT INTO plan (id, name, description, price, duration_days, features, is_active, created_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        ((i, f'plan {i}', f'Generated plan {i}', float(rng.choice((5, 10, 20, 50, 100))),
+          rng.choice((7, 30, 90, 365)), ','.join(f'feature-{j}' for j in range(i % 5 + 1)),
+          True, created) for i in plan_ids)
+    )
+
+    def subscription_rows():
+        # At most one active subscription per user and plan, as the
+        # partial unique index requires
+        active_pairs = set()
+        for _ in range(subscriptions):
+            start = now - timedelta(days=rng.randint(0, 720), seconds=rng.randint(0, 86399))
+            end = start + timedelta(days=30)
+            pair = (rng.choice(user_ids), rng.choice(plan_ids))
+            is_active = rng.random() < 0.8 and pair not in active_pairs
+            if is_active:
+                active_pairs.add(pair)
+            yield (*pair, start.isoformat(' '), end.isoformat(' '), is_active, start.isoformat(' '))
+
+    conn.executemany(
+        'INSERT INTO subscription (user_id, plan_id, start_date, end_date, is_active, created_at) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        subscription_rows()
+    )
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+    return user_ids, plan_ids
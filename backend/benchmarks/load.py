@@ -0,0 +1,275 @@
+"""Load test for every route against a generated dataset.
+
+Builds a fresh SQLite database with N users, M plans and K subscriptions,
+then drives each route either through the Flask test client or through a
+local multi-threaded HTTP server, and prints throughput, p50/p95/p99
+latency and peak RSS as JSON.
+
+    python -m benchmarks.load --users 10000 --subscriptions 100000 --output run.json
+    python -m benchmarks.load --runner http --threads 8 --baseline run.json
+
+With --baseline, scenarios whose throughput dropped or p95 latency rose by
+more than --tolerance are reported and the exit status is non-zero.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from itertools import count
+
+from benchmarks.datagen import PASSWORD, generate
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class TestClientRunner:
+    """Sends requests in-process through the Flask test client."""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, token=None, body=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        response = client.open(path, method=method, headers=headers, json=body)
+        return response.status_code, response.get_data()
+
+    def close(self):
+        pass
+
+
+class HTTPRunner:
+    """Sends requests over loopback HTTP to a threaded werkzeug server."""
+
+    def __init__(self, app):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def request(self, method, path, token=None, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if token:
+            req.add_header('Authorization', f'Bearer {token}')
+        if data is not None:
+            req.add_header('Content-Type', 'application/json')
+        try:
+            with urllib.request.urlopen(req) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def scenarios(admin_token, user_token, user_id, plan_ids, subscriber_token):
+    """(name, weight, request factory) for every route.
+
+    A factory takes a sequence number and returns a list of
+    (method, path, token, body) requests, so write scenarios can create
+    and then clean up after themselves: '{id}' in a path is replaced by the
+    id in the previous response. `subscriber_token` belongs to a user with
+    no subscriptions, so subscribing succeeds.
+    """
+    def login(i):
+        return [('POST', '/login', None, {'username': f'user{user_id}', 'password': PASSWORD})]
+
+    def plan_crud(i):
+        return [
+            ('POST', '/plans', admin_token, {'name': f'bench plan {i}', 'price': 9.5, 'duration_days': 30}),
+            ('PUT', '/plans/{id}', admin_token, {'name': f'bench plan {i} v2', 'description': 'Updated',
+                                                  'price': 12, 'duration_days': 90, 'features': 'a,b'}),
+            ('PATCH', '/plans/{id}', admin_token, {'price': 15}),
+            ('DELETE', '/plans/{id}', admin_token, None),
+        ]
+
+    def subscribe(i):
+        # Cancel, then delete the cancelled row
+        return [
+            ('POST', '/subscriptions', subscriber_token, {'plan_id': plan_ids[i % len(plan_ids)]}),
+            ('DELETE', '/subscriptions/{id}', subscriber_token, None),
+            ('DELETE', '/subscriptions/{id}', subscriber_token, None),
+        ]
+
+    return [
+        ('login', 0.1, login),
+        ('plans', 1.0, lambda i: [('GET', '/plans', None, None)]),
+        ('plans_all', 1.0, lambda i: [('GET', '/plans/all', admin_token, None)]),
+        ('subscriptions', 1.0, lambda i: [('GET', '/subscriptions', user_token, None)]),
+        ('subscriptions_all_page', 1.0,
+         lambda i: [('GET', f'/subscriptions/all?limit=100&cursor={i * 100}', admin_token, None)]),
+        ('users', 0.2, lambda i: [('GET', '/users', admin_token, None)]),
+        ('users_search', 1.0, lambda i: [('GET', f'/users/search?q=user{i % 1000}', admin_token, None)]),
+        ('subscriptions_search', 1.0,
+         lambda i: [('GET', f'/subscriptions/search?q=user{i % 1000}&active=true', admin_token, None)]),
+        ('users_me', 1.0, lambda i: [('GET', '/users/me', user_token, None)]),
+        ('plan_crud', 0.5, plan_crud),
+        ('subscription_lifecycle', 0.5, subscribe),
+    ]
+
+
+def run_scenario(runner, factory, requests, threads):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    sequence = count()
+
+    def worker():
+        nonlocal errors
+        while True:
+            i = next(sequence)
+            if i >= requests:
+                return
+            created_id = None
+            for method, path, token, body in factory(i):
+                if '{id}' in path:
+                    if created_id is None:
+                        break
+                    path = path.format(id=created_id)
+                started = time.perf_counter()
+                status, response = runner.request(method, path, token, body)
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+                    errors += status >= 500
+                if status >= 400:
+                    break
+                if method == 'POST':
+                    created_id = json.loads(response).get('id')
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for name, result in report['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        if result['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {previous['throughput_rps']} -> {result['throughput_rps']} rps")
+        if result['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95_ms']} -> {result['p95_ms']} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--plans', type=int, default=10)
+    parser.add_argument('--subscriptions', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--runner', choices=('client', 'http'), default='client')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario at weight 1.')
+    parser.add_argument('--scenario', action='append', dest='only', help='Run only this scenario; repeatable.')
+    parser.add_argument('--output', help='Write the JSON report to this file.')
+    parser.add_argument('--baseline', help='Compare against a previous JSON report.')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    path = os.path.join(tmp.name, 'load.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+    # The login scenario measures password hashing, not the auth rate limiter
+    os.environ['AUTH_RATE_LIMIT_IP_BURST'] = '0'
+    os.environ['AUTH_RATE_LIMIT_USERNAME_BURST'] = '0'
+
+    import app as subscription_app
+    from werkzeug.security import generate_password_hash
+
+    app = subscription_app.create_app()
+    with app.app_context():
+        # Schema and the admin user (id 1)
+        subscription_app.init_db()
+    user_ids, plan_ids = generate(
+        path, args.users, args.plans, args.subscriptions, seed=args.seed, first_user_id=2,
+        password_hash=generate_password_hash(PASSWORD, app.config['PASSWORD_HASH_METHOD'])
+    )
+    with app.app_context():
+        subscription_app.rebuild_analytics()
+
+    runner = TestClientRunner(app) if args.runner == 'client' else HTTPRunner(app)
+    _, body = runner.request('POST', '/login', body={'username': 'admin', 'password': 'admin123'})
+    admin_token = json.loads(body)['access_token']
+    user_id = user_ids[len(user_ids) // 2]
+    _, body = runner.request('POST', '/login', body={'username': f'user{user_id}', 'password': PASSWORD})
+    user_token = json.loads(body)['access_token']
+    subscriber = {'username': 'bench subscriber', 'password': PASSWORD}
+    runner.request('POST', '/register', body=dict(subscriber, email='bench-subscriber@example.com'))
+    _, body = runner.request('POST', '/login', body=subscriber)
+    subscriber_token = json.loads(body)['access_token']
+
+    results = {}
+    for name, weight, factory in scenarios(admin_token, user_token, user_id, list(plan_ids), subscriber_token):
+        if args.only and name not in args.only:
+            continue
+        requests = max(1, int(args.requests * weight))
+        results[name] = run_scenario(runner, factory, requests, args.threads)
+        print(f"{name}: {results[name]['throughput_rps']} rps, p95 {results[name]['p95_ms']} ms",
+              file=sys.stderr)
+    runner.close()
+
+    report = {
+        'dataset': {'users': args.users, 'plans': args.plans,
+                    'subscriptions': args.subscriptions, 'seed': args.seed},
+        'runner': args.runner,
+        'threads': args.threads,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'scenarios': results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Password hashing micro-benchmark.
+
+Measures logins (hash verifications) per second on a single core for each
+hash setting, and through a process pool using every core, so
+PASSWORD_HASH_METHOD and PASSWORD_HASH_WORKERS can be tuned.
+
+    python -m benchmarks.password_hashing --seconds 2
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+METHODS = (
+    'pbkdf2:sha256:600000',
+    'pbkdf2:sha256:260000',
+    'pbkdf2:sha256:100000',
+    'pbkdf2:sha512:260000',
+)
+
+
+def verify_for(pwhash, seconds):
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        check_password_hash(pwhash, 'benchmark-password')
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--method', action='append', dest='methods',
+                        help='Hash method to measure; repeatable.')
+    args = parser.parse_args()
+
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for method in args.methods or METHODS:
+            pwhash = generate_password_hash('benchmark-password', method)
+
+            single = verify_for(pwhash, args.seconds) / args.seconds
+            counts = pool.map(verify_for, [pwhash] * args.workers, [args.seconds] * args.workers)
+            pooled = sum(counts) / args.seconds
+
+            results.append({
+                'method': method,
+                'logins_per_second_per_core': round(single, 1),
+                'logins_per_second_pooled': round(pooled, 1),
+                'workers': args.workers,
+            })
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""Query-plan regression check for the routes and background jobs.
+
+Seeds a throwaway SQLite database, drives every route through the Flask
+test client and runs the background jobs (expiry, renewals, outbox
+compaction), capturing each statement the app actually issues. Fails if
+SQLite plans a full SCAN over a large table for any of them, unless the
+check is listed in ALLOWED_SCANS.
+
+    python -m benchmarks.query_plans --subscriptions 1000000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from benchmarks.datagen import PASSWORD, generate
+
+LARGE_TABLES = ('subscription', 'user', 'change_event')
+EXPLAINED = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')
+# Hashing cost is irrelevant here
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+
+# Checks whose statements read whole tables on purpose
+ALLOWED_SCANS = {
+    'GET /subscriptions/all': 'unpaginated listing of every subscription',
+    'GET /subscriptions/all?limit=100': 'first page walks the primary key in id order and stops after `limit` rows',
+    'GET /subscriptions/all?active=true&limit=100': 'first page walks the primary key in id order; '
+                                                    'most rows are active, so it stops after about `limit`',
+    'GET /subscriptions/all?active=false&limit=100': 'inactive rows have no index in id order; '
+                                                     'pages walk the table until `limit` match',
+    'GET /subscriptions/all?stream=1': 'NDJSON stream of every subscription',
+    'GET /subscriptions/export': 'export of every subscription',
+    'rebuild_analytics': 'recomputes the aggregates from every subscription',
+}
+
+
+def checks(user_id, plan_id, now):
+    """(method, path, user, body) requests; user is 'admin', 'user' or None.
+
+    '{created}' in a path is the id of the subscription created earlier.
+    """
+    end_after = (now - timedelta(days=7)).isoformat()
+    return [
+        ('POST', '/login', None, {'username': f'user{user_id}', 'password': PASSWORD}),
+        ('POST', '/register', None, {'username': 'plans-check', 'password': PASSWORD,
+                                     'email': 'plans-check@example.com'}),
+        ('GET', '/users/me', 'user', None),
+        ('GET', f'/users/{user_id}', 'admin', None),
+        ('GET', '/users', 'admin', None),
+        ('GET', '/plans', None, None),
+        ('GET', '/plans/all', 'admin', None),
+        ('POST', '/subscriptions', 'user', {'plan_id': plan_id}),
+        ('GET', '/subscriptions', 'user', None),
+        ('GET', '/subscriptions/all', 'admin', None),
+        ('GET', '/subscriptions/all?limit=100', 'admin', None),
+        ('GET', '/subscriptions/all?limit=100&cursor=5000', 'admin', None),
+        ('GET', f'/subscriptions/all?user_id={user_id}', 'admin', None),
+        ('GET', f'/subscriptions/all?plan_id={plan_id}&limit=100', 'admin', None),
+        ('GET', '/subscriptions/all?active=true&limit=100', 'admin', None),
+        ('GET', '/subscriptions/all?active=false&limit=100', 'admin', None),
+        ('GET', f'/subscriptions/all?end_after={end_after}&end_before={now.isoformat()}', 'admin', None),
+        ('GET', '/subscriptions/all?stream=1', 'admin', None),
+        ('GET', '/users/search?q=user12&limit=20', 'admin', None),
+        ('GET', '/subscriptions/search?q=user12&active=true&limit=20', 'admin', None),
+        ('GET', f'/entitlements/{user_id}?feature=feature-0', 'user', None),
+        ('POST', '/entitlements/batch', 'admin', {'user_ids': list(range(user_id, user_id + 50))}),
+        ('GET', '/analytics/summary', 'admin', None),
+        ('GET', '/changes?since=5000&limit=100', 'admin', None),
+        ('GET', '/users/export', 'admin', None),
+        ('GET', '/subscriptions/export', 'admin', None),
+        ('DELETE', '/subscriptions/{created}', 'user', None),
+        ('DELETE', f'/users/{user_id + 1}', 'admin', None),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--plans', type=int, default=20)
+    parser.add_argument('--subscriptions', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'query_plans.db')
+        import app as subscription_app
+
+        app = subscription_app.create_app({
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}',
+            'PASSWORD_HASH_METHOD': PASSWORD_HASH_METHOD,
+            'PASSWORD_HASH_WORKERS': 0,
+            'EXPIRY_SWEEP_INTERVAL': 0,
+            'AUTH_RATE_LIMIT_IP_BURST': 0,
+            'AUTH_RATE_LIMIT_USERNAME_BURST': 0,
+            'SUBSCRIPTION_LIST_CACHE_SIZE': 0,
+        })
+        context = app.app_context()
+        context.push()
+        subscription_app.init_db()
+        user_ids, plan_ids = generate(
+            path, args.users, args.plans, args.subscriptions, first_user_id=2,
+            password_hash=generate_password_hash(PASSWORD, PASSWORD_HASH_METHOD))
+        user_id = user_ids[0]
+        conn = sqlite3.connect(path)
+        # A plan the checked user can subscribe to
+        active = {plan_id for plan_id, in conn.execute(
+            'SELECT plan_id FROM subscription WHERE user_id = ? AND is_active = 1', (user_id,))}
+        plan_id = next(plan_id for plan_id in plan_ids if plan_id not in active)
+        # One outbox row per subscription, so change feed queries see a large table
+        conn.execute("INSERT INTO change_event (entity, entity_id, action, data, created_at) "
+                     "SELECT 'subscription', id, 'created', '{}', start_date FROM subscription")
+        conn.commit()
+        conn.close()
+
+        statements = []
+
+        @subscription_app.db.event.listens_for(subscription_app.db.engine, 'before_cursor_execute')
+        def explain(conn, cursor, statement, parameters, context, executemany):
+            # Background threads (the user purge) would mix into the current check
+            if (executemany or threading.current_thread() is not threading.main_thread()
+                    or not statement.lstrip().upper().startswith(EXPLAINED)):
+                return
+            rows = cursor.connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            statements.append((statement, [row[-1] for row in rows]))
+
+        results = []
+
+        def run(label, fn):
+            statements.clear()
+            fn()
+            results.append((label, list(statements)))
+
+        run('rebuild_analytics', subscription_app.rebuild_analytics)
+        client = app.test_client()
+        tokens = {}
+        for name, credentials in (('admin', {'username': 'admin', 'password': 'admin123'}),
+                                  ('user', {'username': f'user{user_id}', 'password': PASSWORD})):
+            tokens[name] = client.post('/login', json=credentials).json['access_token']
+        now = datetime.utcnow()
+        created = {}
+
+        for method, path_template, user, body in checks(user_id, plan_id, now):
+            path_ = path_template.format(**created)
+            headers = {'Authorization': f'Bearer {tokens[user]}'} if user else {}
+
+            def request(method=method, path_=path_, headers=headers, body=body):
+                response = client.open(path_, method=method, headers=headers, json=body)
+                response.get_data()
+                if response.status_code >= 500:
+                    raise SystemExit(f'{method} {path_} failed: {response.status_code} {response.get_data()!r}')
+                if method == 'POST' and path_ == '/subscriptions':
+                    assert response.status_code == 201, response.get_data()
+                    created['created'] = response.json['id']
+
+            run(f'{method} {path_template}', request)
+
+        run('expire_subscriptions', subscription_app.expire_subscriptions)
+        run('renew_subscriptions', lambda: subscription_app.renew_subscriptions(24 * 30, 0, 1000, resume=False))
+        run('compact_changes', lambda: subscription_app.compact_changes(now + timedelta(days=400)))
+        run('purge_deleted_users', subscription_app.purge_deleted_users)
+        subscription_app.db.engine.dispose()
+        context.pop()
+
+    failures = 0
+    scanned = set()
+    for label, captured in results:
+        label = label.replace('{created}', '<id>')
+        scans = [line for _, plan in captured for line in plan
+                 if line.startswith('SCAN ') and line.split()[1].strip('"') in LARGE_TABLES]
+        allowed = ALLOWED_SCANS.get(label)
+        status = 'FAIL' if scans and not allowed else ('scan' if scans else 'ok  ')
+        print(f'{status} {label}' + (f'  (allowed: {allowed})' if scans and allowed else ''))
+        for statement, plan in captured:
+            print(f"       {' '.join(statement.split())[:100]}")
+            for line in plan:
+                print(f'           {line}')
+        failures += status == 'FAIL'
+        if scans:
+            scanned.add(label)
+
+    unused = set(ALLOWED_SCANS) - scanned
+    for label in sorted(unused):
+        print(f'FAIL ALLOWED_SCANS entry matches no scanning check: {label}')
+    failures += len(unused)
+
+    if failures:
+        print(f'{failures} checks failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Mixed read/write throughput with and without read routing.
+
+Generates one SQLite database (WAL, DB_PROFILE=production), then for each
+mode runs reader threads paging through the admin listings while writer
+threads create and cancel subscriptions, all through the Flask test client.
+'primary' sends every statement to the primary engine; 'routed' sets
+DATABASE_READ_URL to read-only connections on the same file.
+
+    python -m benchmarks.read_routing --readers 8 --writers 4 --seconds 10
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.load import percentile
+
+MODES = ('primary', 'routed')
+READ_PATHS = (
+    '/subscriptions/all?limit=500&cursor={cursor}',
+    '/subscriptions/all?plan_id={plan_id}&limit=100',
+    '/users/search?q=user{user_id}&limit=20',
+    '/analytics/summary'
+)
+
+
+def run_mode(mode, readers, writers, seconds, subscriptions, plans):
+    from app import create_app
+
+    app = create_app()
+    client = app.test_client()
+    token = client.post('/login', json={'username': 'admin', 'password': 'admin123'}).json['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    plan_ids = [
+        client.post('/plans', headers=headers, json={
+            'name': f'routing plan {mode} {i}', 'price': 10, 'duration_days': 30
+        }).json['id']
+        for i in range(writers)
+    ]
+    # Writers use their own accounts, so the read-your-writes window of the
+    # admin does not pin the readers to the primary
+    writer_headers = []
+    for i in range(writers):
+        credentials = {'username': f'writer {mode} {i}', 'password': 'benchmark'}
+        client.post('/register', json=dict(credentials, email=f'writer-{mode}-{i}@example.com'))
+        writer_token = client.post('/login', json=credentials).json['access_token']
+        writer_headers.append({'Authorization': f'Bearer {writer_token}'})
+
+    latencies = {'reads': [], 'writes': []}
+    errors = {'reads': 0, 'writes': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def record(kind, started, response):
+        elapsed = time.perf_counter() - started
+        with lock:
+            if response.status_code < 400:
+                latencies[kind].append(elapsed)
+            else:
+                errors[kind] += 1
+
+    def reader(seed):
+        rng = random.Random(seed)
+        thread_client = app.test_client()
+        while time.perf_counter() < deadline:
+            path = rng.choice(READ_PATHS).format(
+                cursor=rng.randrange(subscriptions), plan_id=rng.randint(1, plans),
+                user_id=rng.randint(1, 1000))
+            started = time.perf_counter()
+            record('reads', started, thread_client.get(path, headers=headers))
+
+    def writer(plan_id, headers):
+        thread_client = app.test_client()
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = thread_client.post('/subscriptions', headers=headers, json={'plan_id': plan_id})
+            record('writes', started, response)
+            if response.status_code == 201:
+                started = time.perf_counter()
+                record('writes', started, thread_client.delete(
+                    f"/subscriptions/{response.json['id']}", headers=headers))
+
+    threads = [threading.Thread(target=reader, args=(seed,)) for seed in range(readers)]
+    threads += [threading.Thread(target=writer, args=args) for args in zip(plan_ids, writer_headers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    result = {'mode': mode, 'readers': readers, 'writers': writers}
+    for kind, samples in latencies.items():
+        samples.sort()
+        result[f'{kind}_per_second'] = round(len(samples) / elapsed, 1)
+        result[f'{kind}_p95_ms'] = round(percentile(samples, 0.95) * 1000, 2)
+        result[f'{kind}_errors'] = errors[kind]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--plans', type=int, default=20)
+    parser.add_argument('--subscriptions', type=int, default=200_000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--mode', choices=MODES, help='Run a single mode in this process (used internally).')
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.readers, args.writers, args.seconds,
+                                  args.subscriptions, args.plans)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pristine = os.path.join(tmp, 'pristine.db')
+        env = dict(os.environ, DB_PROFILE='production', DATABASE_URL=f'sqlite:///{pristine}',
+                   PASSWORD_HASH_WORKERS='0')
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app:create_app', 'init-db'],
+                       env=env, check=True, capture_output=True)
+        from benchmarks.datagen import generate
+        generate(pristine, args.users, args.plans, args.subscriptions, first_user_id=2)
+
+        results = []
+        for mode in MODES:
+            path = os.path.join(tmp, f'{mode}.db')
+            shutil.copyfile(pristine, path)
+            env = dict(env, DATABASE_URL=f'sqlite:///{path}')
+            env.pop('DATABASE_READ_URL', None)
+            if mode == 'routed':
+                env['DATABASE_READ_URL'] = f'sqlite:///file:{path}?mode=ro&uri=true'
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.read_routing', '--mode', mode,
+                 '--readers', str(args.readers), '--writers', str(args.writers),
+                 '--seconds', str(args.seconds), '--subscriptions', str(args.subscriptions),
+                 '--plans', str(args.plans)],
+                env=env, check=True, capture_output=True, text=True
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Concurrent renewal check.
+
+Generates one SQLite database (WAL, DB_PROFILE=production) and, for each
+mode, starts two processes renewing at the same moment:
+
+    runs        both call renew_subscriptions with a new run, as two workers
+                handling POST /subscriptions/renewals (or the CLI next to
+                the endpoint) would
+    partitions  both process the same run, bypassing the run guard, so the
+                partition checkpoints and the renewal UPDATE alone must keep
+                rows from being renewed twice
+
+Every candidate must end up extended by exactly one plan duration, and
+the renewal revenue in DailyStats must match. Prints PASS/FAIL per mode
+and exits non-zero on failure.
+
+    python -m benchmarks.renewal_race --subscriptions 200000 --batch-size 100
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+MODES = ('runs', 'partitions')
+
+
+def run_worker(mode, now, window_hours, batch_size, run_id, start_at):
+    from app import RenewalInProgress, create_app, process_renewal_run, renew_subscriptions
+
+    app = create_app()
+    with app.app_context():
+        time.sleep(max(0.0, start_at - time.time()))
+        try:
+            if mode == 'runs':
+                stats = renew_subscriptions(window_hours, 0, batch_size, now=now, resume=False)
+            else:
+                stats = process_renewal_run(run_id, 0, batch_size)
+        except RenewalInProgress as e:
+            return {'skipped': str(e)}
+    return {'renewed': stats['renewed']}
+
+
+def candidates(path, now, window_end):
+    conn = sqlite3.connect(path)
+    rows = conn.execute(
+        'SELECT s.id, s.end_date, p.duration_days, p.price FROM subscription s '
+        'JOIN plan p ON p.id = s.plan_id '
+        'WHERE s.is_active = 1 AND p.is_active = 1 AND s.end_date >= ? AND s.end_date < ?',
+        (now.isoformat(' '), window_end.isoformat(' '))
+    ).fetchall()
+    conn.close()
+    return rows
+
+
+def renewal_revenue(path):
+    conn = sqlite3.connect(path)
+    revenue = conn.execute('SELECT COALESCE(SUM(revenue), 0), COALESCE(SUM(renewals), 0) '
+                           'FROM daily_stats WHERE renewals > 0').fetchone()
+    conn.close()
+    return revenue
+
+
+def check(path, before, revenue_before):
+    """Compare each candidate's end_date with one renewal; returns problem counts."""
+    conn = sqlite3.connect(path)
+    end_dates = dict(conn.execute('SELECT id, end_date FROM subscription').fetchall())
+    conn.close()
+    doubled = missed = 0
+    for subscription_id, end_date, duration_days, _ in before:
+        expected = datetime.fromisoformat(end_date) + timedelta(days=duration_days)
+        actual = datetime.fromisoformat(end_dates[subscription_id])
+        doubled += actual > expected
+        missed += actual < expected
+    revenue, renewals = renewal_revenue(path)
+    return {
+        'candidates': len(before),
+        'doubled': doubled,
+        'missed': missed,
+        'renewals_counted': renewals - revenue_before[1],
+        'revenue_counted': round(revenue - revenue_before[0], 2),
+        'revenue_expected': round(sum(price for _, _, _, price in before), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--plans', type=int, default=10)
+    parser.add_argument('--subscriptions', type=int, default=200_000)
+    parser.add_argument('--window-hours', type=float, default=30 * 24)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--worker', choices=MODES, help='Renew in this process (used internally).')
+    parser.add_argument('--now')
+    parser.add_argument('--run-id', type=int)
+    parser.add_argument('--start-at', type=float, default=0)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, datetime.fromisoformat(args.now), args.window_hours,
+                                    args.batch_size, args.run_id, args.start_at)))
+        return
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        pristine = os.path.join(tmp, 'pristine.db')
+        env = dict(os.environ, DB_PROFILE='production', DATABASE_URL=f'sqlite:///{pristine}',
+                   PASSWORD_HASH_WORKERS='0', EXPIRY_SWEEP_INTERVAL='0')
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app:create_app', 'init-db'],
+                       env=env, check=True, capture_output=True)
+        from benchmarks.datagen import generate
+        generate(pristine, args.users, args.plans, args.subscriptions, first_user_id=2)
+
+        now = datetime.utcnow()
+        window_end = now + timedelta(hours=args.window_hours)
+        for mode in MODES:
+            path = os.path.join(tmp, f'{mode}.db')
+            shutil.copyfile(pristine, path)
+            env = dict(env, DATABASE_URL=f'sqlite:///{path}')
+            before = candidates(path, now, window_end)
+            revenue_before = renewal_revenue(path)
+
+            run_id = None
+            if mode == 'partitions':
+                output = subprocess.run(
+                    [sys.executable, '-c',
+                     'import json, sys; from datetime import datetime; '
+                     'from app import create_app, open_renewal_run; app = create_app()\n'
+                     'with app.app_context():\n'
+                     '    run, _ = open_renewal_run(float(sys.argv[1]), 0, datetime.fromisoformat(sys.argv[2]), False)\n'
+                     '    print(run.id)',
+                     str(args.window_hours), now.isoformat()],
+                    env=env, check=True, capture_output=True, text=True
+                ).stdout
+                run_id = int(output.strip().splitlines()[-1])
+
+            start_at = time.time() + 3
+            command = [sys.executable, '-m', 'benchmarks.renewal_race', '--worker', mode,
+                       '--now', now.isoformat(), '--window-hours', str(args.window_hours),
+                       '--batch-size', str(args.batch_size), '--start-at', str(start_at)]
+            if run_id is not None:
+                command += ['--run-id', str(run_id)]
+            processes = [subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True)
+                         for _ in range(2)]
+            workers = []
+            for process in processes:
+                stdout, _ = process.communicate()
+                if process.returncode:
+                    raise SystemExit(f'{mode} worker exited with {process.returncode}')
+                workers.append(json.loads(stdout.strip().splitlines()[-1]))
+
+            result = check(path, before, revenue_before)
+            result['workers'] = workers
+            ok = (not result['doubled'] and not result['missed']
+                  and result['renewals_counted'] == result['candidates']
+                  and abs(result['revenue_counted'] - result['revenue_expected']) < 0.01)
+            failed |= not ok
+            print(f"{'PASS' if ok else 'FAIL'} {mode}: {json.dumps(result)}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
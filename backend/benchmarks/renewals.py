@@ -0,0 +1,65 @@
+"""Renewal engine throughput.
+
+Renews every active subscription ending within the window, starting from
+the same generated database for each worker count, and reports renewals
+per second. A second, resumed call per run checks the checkpoints: it must
+find nothing left to renew.
+
+    python -m benchmarks.renewals --subscriptions 500000 --workers 0 2 4
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50_000)
+    parser.add_argument('--plans', type=int, default=20)
+    parser.add_argument('--subscriptions', type=int, default=200_000)
+    parser.add_argument('--window-hours', type=float, default=30 * 24)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4])
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    path = os.path.join(tmp.name, 'renewals.db')
+    pristine = os.path.join(tmp.name, 'pristine.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+
+    from app import RenewalRun, create_app, db, init_db, renew_subscriptions
+    from benchmarks.datagen import generate
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+    generate(path, args.users, args.plans, args.subscriptions, first_user_id=2)
+    shutil.copyfile(path, pristine)
+
+    results = []
+    for workers in args.workers:
+        with app.app_context():
+            db.engine.dispose()
+            shutil.copyfile(pristine, path)
+            stats = renew_subscriptions(args.window_hours, workers, args.batch_size, resume=False)
+            # Mark the run unfinished again, as if interrupted after its last batch
+            RenewalRun.query.filter_by(id=stats['run_id']).update({'finished_at': None})
+            db.session.commit()
+            resumed = renew_subscriptions(workers=workers)
+        results.append({
+            'workers': workers,
+            'renewed': stats['renewed'],
+            'partitions': stats['partitions'],
+            'seconds': stats['seconds'],
+            'renewals_per_second': stats['renewals_per_second'],
+            'renewed_on_resume': resumed['renewed']
+        })
+
+    print(json.dumps({'subscriptions': args.subscriptions, 'window_hours': args.window_hours,
+                      'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
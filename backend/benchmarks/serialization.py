@@ -0,0 +1,96 @@
+"""Serialization benchmark for the list endpoints.
+
+Compares building subscription and user lists from hydrated ORM objects
+(the previous approach) with the column projections used by the routes,
+reporting wall time and peak traced allocations for each.
+
+    python -m benchmarks.serialization --rows 100000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+
+def measure(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': round(best, 4), 'peak_allocated_bytes': peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    path = os.path.join(tmp.name, 'serialization.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+
+    import app as subscription_app
+    from app import (SUBSCRIPTION_ADMIN_FIELDS, SUBSCRIPTION_PROJECTION, USER_FIELDS, USER_PROJECTION,
+                     Subscription, User, create_app, db, dumps_json, init_db)
+    from benchmarks.datagen import generate
+    from sqlalchemy.orm import joinedload
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+    generate(path, users=args.rows, plans=10, subscriptions=args.rows, first_user_id=2)
+
+    def orm_subscriptions():
+        subscriptions = Subscription.query.options(
+            joinedload(Subscription.user), joinedload(Subscription.plan)
+        ).order_by(Subscription.id).all()
+        json.dumps([{
+            'id': sub.id,
+            'user_id': sub.user_id,
+            'username': sub.user.username,
+            'plan_id': sub.plan_id,
+            'plan_name': sub.plan.name,
+            'start_date': sub.start_date.isoformat(),
+            'end_date': sub.end_date.isoformat(),
+            'is_active': sub.is_active and not sub.is_expired()
+        } for sub in subscriptions])
+        db.session.expunge_all()
+
+    def projected_subscriptions():
+        dumps_json(SUBSCRIPTION_PROJECTION.fetch(list(SUBSCRIPTION_ADMIN_FIELDS), order_by=Subscription.id))
+
+    def orm_users():
+        json.dumps([{
+            'id': user.id,
+            'username': user.username,
+            'email': user.email,
+            'role': user.role,
+            'created_at': user.created_at.isoformat() if user.created_at else None
+        } for user in User.query.all()])
+        db.session.expunge_all()
+
+    def projected_users():
+        dumps_json(USER_PROJECTION.fetch(list(USER_FIELDS), order_by=User.id))
+
+    results = {}
+    with app.app_context():
+        for name, fn in (('subscriptions_orm', orm_subscriptions),
+                         ('subscriptions_projection', projected_subscriptions),
+                         ('users_orm', orm_users),
+                         ('users_projection', projected_users)):
+            results[name] = measure(fn, args.repeat)
+
+    print(json.dumps({'rows': args.rows, 'orjson': subscription_app.orjson is not None,
+                      'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Worker boot time.
+
+Imports the app module and calls create_app() in fresh interpreters, as a
+new worker would, and reports the median time of each step. The database
+URL points at a file that does not exist; the check fails if booting
+creates it, i.e. if anything touches the database before the first request.
+
+    python -m benchmarks.startup --runs 20
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BOOT = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'create_app_ms': (created - imported) * 1000}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'startup.db')
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}')
+        samples = []
+        for _ in range(args.runs):
+            output = subprocess.run([sys.executable, '-c', BOOT], cwd=backend, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+            samples.append(json.loads(output.splitlines()[-1]))
+        touched = os.path.exists(path)
+
+    report = {
+        'runs': args.runs,
+        'import_ms': round(statistics.median(s['import_ms'] for s in samples), 1),
+        'create_app_ms': round(statistics.median(s['create_app_ms'] for s in samples), 1),
+        'database_touched': touched
+    }
+    print(json.dumps(report, indent=2))
+    if touched:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()